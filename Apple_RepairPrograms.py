@@ -1,9 +1,9 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 """
 ###################################################################################################
 # Script Name:  Apple_RepairPrograms.py
 # By:  Zack Thompson / Created:  8/24/2019
-# Version:  1.1.0 / Updated:  2/12/2021 / By:  ZT
+# Version:  1.11.0 / Updated:  10/18/2026 / By:  ZT
 #
 # Description:  This script looks up provided devices and checks if they're eligible for a recall program.
 #
@@ -20,122 +20,558 @@
 """
 
 import argparse
+import base64
+import calendar
+import collections
 import csv
+import datetime
+import functools
+import getpass
+import http.client
+import itertools
 import json
+import multiprocessing
 import os
+import queue
+import random
 import re
-import subprocess
+import shutil
+import sqlite3
 import sys
+import threading
 import time
 import uuid
 
-try:
-    from urllib import request as urllib  # For Python 3
-except ImportError:
-    import urllib2 as urllib # For Python 2
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlsplit
 
 
-def runUtility(command):
-    """A helper function for subprocess.
+QUALITY_PROGRAMS_URL = "https://qualityprograms.apple.com"
+
+JAMF_PRO_API_ENDPOINTS = {
+    "auth_token": "/api/v1/auth/token",
+    "computers_inventory": "/api/v1/computers-inventory"
+}
+
+
+# Active Exchange and Repair Extension Programs and the models they apply to.
+#   To add a program, add an entry below.  Models may be a marketing name or a model identifier
+#   and will also be matched when found within a longer string, unless `exact` is set.
+EXCHANGE_PROGRAMS = [
+    {
+        "program": "062019",
+        "name": "15-inch MacBook Pro Battery Recall Program",
+        "url": "https://support.apple.com/15-inch-macbook-pro-battery-recall",
+        "models": [
+            "MacBook Pro (Retina, 15-inch, Mid 2015)",
+            "15-inch Retina MacBook Pro (Mid 2015)",
+            "MacBookPro11,4",
+            "MacBookPro11,5"
+        ]
+    },
+    {
+        "program": "112018",
+        "name": "13-inch MacBook Pro (non Touch Bar) Solid-State Drive Service Program",
+        "url": "https://support.apple.com/13-inch-macbook-pro-solid-state-drive-service",
+        "models": [
+            "MacBook Pro (13-inch, 2017, Two Thunderbolt 3 ports)",
+            "13-inch Retina MacBook Pro (Mid 2017)",
+            "MacBookPro11,4",
+            "MacBookPro14,1"
+        ]
+    },
+    {
+        "program": "032018",
+        "name": "13-inch MacBook Pro (non Touch Bar) Battery Replacement Program",
+        "url": "https://support.apple.com/13inch-macbookpro-battery-replacement",
+        "models": [
+            "13-inch MacBook Pro (non Touch Bar)",
+            "13-inch Retina MacBook Pro (Late 2016)",
+            "13-inch Retina MacBook Pro (Mid 2017)",
+            "MacBookPro13,1",
+            "MacBookPro14,1"
+        ]
+    },
+    {
+        "program": "122020",
+        "name": "iPhone 11 Display Module Replacement Program for Touch Issues",
+        "url": "https://support.apple.com/iphone-11-display-module-replacement-program",
+        "models": [ "iPhone 11" ],
+        "exact": True
+    },
+    {
+        "program": "082018",
+        "name": "iPhone 8 Logic Board Replacement Program",
+        "url": "https://support.apple.com/iphone-8-logic-board-replacement-program",
+        "models": [ "iPhone 8" ],
+        "exact": True
+    },
+    {
+        "program": "102019",
+        "name": "iPhone 6s and iPhone 6s Plus Service Program for No Power Issues",
+        "url": "https://support.apple.com/iphone-6s-6s-plus-no-power-issues-program",
+        "models": [ "iPhone 6S", "iPhone 6 Plus" ],
+        "exact": True
+    },
+
+# Discontinued programs
+
+    # {
+    #     "program": "112016",
+    #     "name": "iPhone 6s Program for Unexpected Shutdown Issues",
+    #     "url": "https://support.apple.com/iphone6s-unexpectedshutdown",
+    #     "models": [ "iPhone 6S" ],
+    #     "exact": True
+    # },
+    # {
+    #     "program": "082015",
+    #     "name": "iSight Camera Replacement Program for iPhone 6 Plus",
+    #     "url": "https://support.apple.com/iphone6plus-isightcamera",
+    #     "models": [ "iPhone 6 Plus" ],
+    #     "exact": True
+    # },
+]
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket used to pace the requests sent to Apple's API.
+
+    The pace adapts to how Apple is responding:  it's halved each time a request is throttled
+    or fails and then climbs back up to `rate` while responses are healthy.
+
     Args:
-        command:  String containing the commands and arguments that will be passed to a shell.
-    Returns:
-        stdout:  output of the command
+        rate:  Max number of requests allowed per second.  A rate of 0 disables the limit.
+        burst:  Number of requests that can be sent back-to-back before being throttled.
     """
 
-    try:
-        process = subprocess.check_output(command, shell=True)
-    except subprocess.CalledProcessError as error:
-        print ('Error code:  {}'.format(error.returncode))
-        print ('Error:  {}'.format(error))
-        process = "error"
+    def __init__(self, rate, burst=1, state=None, lock=None):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        # The available tokens, when they were last refilled and the current pace
+        self._state = state if state is not None else [float(self.burst), time.monotonic(), self.rate]
+        self._lock = lock or threading.Lock()
+
+    @classmethod
+    def shared(cls, rate, burst=1, context=multiprocessing):
+        """Creates a limiter whose request budget is shared with worker processes.
+
+        Args:
+            rate:  Number of requests allowed per second.  A rate of 0 disables the limit.
+            burst:  Number of requests that can be sent back-to-back before being throttled.
+            context:  The multiprocessing context the worker processes will be started from
+        """
+
+        state = context.Array('d', [float(max(1, int(burst))), time.monotonic(), float(rate)])
+        return cls(rate, burst, state=state, lock=state.get_lock())
+
+    def penalize(self):
+        """Halves the pace after a throttled or failed request."""
+
+        with self._lock:
+            self._state[2] = max(self.rate / 64, self._state[2] / 2)
+
+    def reward(self):
+        """Speeds the pace back up after a healthy response."""
+
+        with self._lock:
+            self._state[2] = min(self.rate, self._state[2] + self.rate / 20)
+
+    def acquire(self):
+        """Blocks until a request is allowed to be sent."""
+
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens = min(self.burst, self._state[0] + (now - self._state[1]) * self._state[2])
+                self._state[1] = now
+
+                if tokens >= 1:
+                    self._state[0] = tokens - 1
+                    return
+
+                self._state[0] = tokens
+                wait = (1 - tokens) / self._state[2]
+
+            time.sleep(wait)
+
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter, bounded by a retry budget for the whole run.
+
+    Args:
+        budget:  Total number of retries allowed during the run
+        max_attempts:  Max number of attempts for a single lookup
+        base_delay:  Number of seconds to wait before the first retry, doubled for each retry after
+        max_delay:  Max number of seconds to wait before a retry
+    """
+
+    def __init__(self, budget=100, max_attempts=5, base_delay=1, max_delay=60, state=None, lock=None):
+        self.budget = budget
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # The number of retries remaining
+        self._state = state if state is not None else [budget]
+        self._lock = lock or threading.Lock()
+
+    @classmethod
+    def shared(cls, budget=100, max_attempts=5, context=multiprocessing, **kwargs):
+        """Creates a policy whose retry budget is shared with worker processes."""
+
+        state = context.Array('i', [budget])
+        return cls(budget, max_attempts, state=state, lock=state.get_lock(), **kwargs)
+
+    @property
+    def remaining(self):
+        return self._state[0]
+
+    @staticmethod
+    def retryable(status_code):
+        """Returns True if a response indicates the request should be tried again."""
+
+        return status_code is None or status_code == 429 or status_code >= 500
+
+    def allow(self, attempt):
+        """Returns True, and spends one retry from the budget, if another attempt can be made.
+
+        Args:
+            attempt:  The number of the attempt that just failed, starting from 0
+        """
+
+        if attempt + 1 >= self.max_attempts:
+            return False
+
+        with self._lock:
+            if self._state[0] <= 0:
+                return False
+
+            self._state[0] -= 1
+            return True
+
+    def delay(self, attempt):
+        """Returns the number of seconds to wait before the next attempt."""
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class FailureLog(object):
+    """Records the lookups that could not be completed.
+
+    The log is a CSV with serial number and model columns, so it can be passed straight back
+    to --input for a targeted re-run.
+
+    Args:
+        path:  Path to the CSV where failures will be written
+        append:  Keep the failures already recorded, e.g. when resuming a run
+    """
+
+    field_names = ["Serial Number", "Model", "Program", "Reason"]
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.count = 0
+        self._file = None
+        self._writer = None
+        self._lock = threading.Lock()
+
+        if not append and os.path.exists(path):
+            os.remove(path)
+
+    def record(self, serial, model, program, reason):
+        """Writes a failed lookup to the log."""
+
+        with self._lock:
+            if not self._file:
+                new_file = not os.path.exists(self.path)
+                self._file = open(self.path, mode='a', newline='')
+                self._writer = csv.writer(self._file)
+
+                if new_file:
+                    self._writer.writerow(self.field_names)
+
+            self._writer.writerow([serial, model, program, reason])
+            self._file.flush()
+            self.count += 1
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+class EligibilityCache(object):
+    """An on-disk cache of the eligibility status returned for each serial number and program.
+
+    Eligibility rarely changes, so results are reused until they expire.  When the cache grows
+    past `max_entries`, the results that were checked the longest time ago are evicted first.
+
+    Args:
+        path:  Path to the SQLite database; it will be created if it does not exist
+        ttl:  Number of seconds a cached result is considered valid
+        max_entries:  Max number of results to keep in the cache
+    """
+
+    def __init__(self, path, ttl=604800, max_entries=250000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        if not os.path.exists(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+        with self._lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS eligibility (
+                    serial TEXT NOT NULL,
+                    program TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    checked REAL NOT NULL,
+                    PRIMARY KEY (serial, program)
+                )""")
+            self.connection.execute('CREATE INDEX IF NOT EXISTS eligibility_checked ON eligibility (checked)')
+
+        self.evict()
+
+    def get(self, serial, program):
+        """Returns the cached status for a serial number and program, or None if it's missing or expired."""
+
+        with self._lock:
+            result = self.connection.execute(
+                'SELECT status FROM eligibility WHERE serial = ? AND program = ? AND checked > ?',
+                (serial, program, time.time() - self.ttl)
+            ).fetchone()
+
+        return result[0] if result else None
+
+    def set(self, serial, program, status):
+        """Stores the status for a serial number and program."""
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO eligibility (serial, program, status, checked) VALUES (?, ?, ?, ?)',
+                (serial, program, status, time.time())
+            )
+
+    def evict(self):
+        """Removes expired results and then the oldest results over the max number of entries."""
+
+        with self._lock, self.connection:
+            self.connection.execute('DELETE FROM eligibility WHERE checked <= ?', (time.time() - self.ttl,))
+            self.connection.execute(
+                'DELETE FROM eligibility WHERE rowid IN (SELECT rowid FROM eligibility ORDER BY checked DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def close(self):
+        """Applies the eviction policy and closes the database."""
+
+        self.evict()
+        self.connection.close()
+
+
+class LookupClient(object):
+    """A pool of keep-alive connections to Apple's API that is shared by every lookup in a batch.
+
+    Reusing connections avoids a new TLS handshake for each request.  If a pooled connection was
+    closed by the server while idle, the request is sent again once over a new connection.
+
+    The latency of each request is sampled (a uniform sample of up to `max_samples` requests is
+    kept) so it can be reported with --stats.
+
+    Args:
+        url:  Base URL of the API
+        pool_size:  Max number of idle connections kept open
+        timeout:  Number of seconds to wait on the server before giving up on a request
+    """
+
+    max_samples = 10000
+
+    def __init__(self, url=QUALITY_PROGRAMS_URL, pool_size=4, timeout=30):
+        url = urlsplit(url)
+        self.connection_type = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.base_path = url.path.rstrip("/")
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=max(1, pool_size))
+        self.requests = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def _record(self, seconds):
+        with self._lock:
+            self.requests += 1
+
+            if len(self.latencies) < self.max_samples:
+                self.latencies.append(seconds)
+
+            else:
+                sample = random.randrange(self.requests)
+
+                if sample < self.max_samples:
+                    self.latencies[sample] = seconds
+
+    def _new_connection(self):
+        return self.connection_type(self.host, self.port, timeout=self.timeout)
+
+    def _send(self, connection, method, path, body, headers):
+        connection.request(method, "{}{}".format(self.base_path, path), body=body, headers=headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def request(self, method, path, body=None, headers=None):
+        """Sends a request over a pooled connection.
+
+        Args:
+            method:  HTTP method
+            path:  Path of the endpoint, relative to the base URL
+            body:  Optional request body
+            headers:  Optional dict of request headers
+        Returns:
+            tuple:  The status code and the content of the response
+        """
+
+        try:
+            connection = self._pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._new_connection()
+            reused = False
+
+        started = time.monotonic()
+
+        try:
+            try:
+                response, content = self._send(connection, method, path, body, headers or {})
+
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # The server closed the idle connection, try once more with a fresh one
+                if not reused:
+                    raise
+
+                connection.close()
+                connection = self._new_connection()
+                response, content = self._send(connection, method, path, body, headers or {})
+
+        except Exception:
+            connection.close()
+            raise
 
-    return process
+        self._record(time.monotonic() - started)
+
+        if response.will_close:
+            connection.close()
+
+        else:
+            try:
+                self._pool.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+
+        return response.status, content
+
+    def close(self):
+        """Closes all idle connections."""
+
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
 
 
 # This function performs the lookup for each serial number against Apple's API
-def exchange_lookup(program, serial, guid):
+def exchange_lookup(program, serial, guid, client):
 
     data = {"serial": serial, "GUID": guid}
-    url = "https://qualityprograms.apple.com/snlookup/{program}".format(program=program)
+    headers = {"Accept": "application/json", "Content-Type": "application/json"}
+
+    statusCode, content = client.request(
+        "POST", "/snlookup/{program}".format(program=program), body=json.dumps(data), headers=headers)
 
     try:
-        # print('Trying urllib...')
-        headers = {'Accept': 'application/json'}
-        request = urllib.Request(url, data=json.dumps(data), headers=headers)
-        response = urllib.urlopen(request)
-        statusCode = response.code
-        json_response = json.loads(response.read())
-
-    except Exception:
-        # If urllib fails, resort to using curl
-        sys.exc_clear()
-        # print('Trying curl...')
-        # Build the command
-        curl_cmd = '/usr/bin/curl --silent --show-error --no-buffer --fail --write-out "statusCode:%{{http_code}}" --location --header "Accept: application/json" --data "{data}" --url {url} --request GET'.format(data=data, url=url)
-        response = runUtility(curl_cmd)
-        json_content, statusCode = response.split('statusCode:')
-        json_response = json.loads(json_content)
-
-    return 200, 'json_response'
+        json_response = json.loads(content)
+    except ValueError:
+        json_response = None
+
+    return statusCode, json_response
+
+
+def build_program_index(exchange_programs):
+    """Compiles the exchange program table into lookup structures.
+
+    Args:
+        exchange_programs:  A list of program definitions, e.g. EXCHANGE_PROGRAMS
+    Returns:
+        tuple:  A dict of each model to the program numbers it's eligible for, and a compiled
+            pattern of the models that may also be matched within a longer model string.
+    """
+
+    index = collections.OrderedDict()
+    partial_models = []
+
+    for exchange_program in exchange_programs:
+        for model in exchange_program["models"]:
+            index.setdefault(model, [])
+
+            if exchange_program["program"] not in index[model]:
+                index[model].append(exchange_program["program"])
+
+            if not exchange_program.get("exact") and model not in partial_models:
+                partial_models.append(model)
+
+    # Prefer the longest match when one model is a substring of another
+    partial_models.sort(key=len, reverse=True)
+    pattern = re.compile("|".join(re.escape(model) for model in partial_models))
+
+    return dict((model, tuple(programs)) for model, programs in index.items()), pattern
+
+
+PROGRAM_INDEX, PROGRAM_PATTERN = build_program_index(EXCHANGE_PROGRAMS)
+PROGRAM_ORDER = dict((exchange_program["program"], order) for order, exchange_program in enumerate(EXCHANGE_PROGRAMS))
 
 
 # This function checks if the model has an available exchange program
+@functools.lru_cache(maxsize=1024)
 def available_exchange_programs(model):
-    program_number = []
-
-    mbp15Battery = re.compile("(?:MacBook Pro \(Retina, 15-inch, Mid 2015\))|(?:15-inch Retina MacBook Pro \(Mid 2015\))|(?:MacBookPro11,4)|(?:MacBookPro11,5)")
-    if mbp15Battery.search(str(model)):
-        # 15-inch MacBook Pro Battery Recall Program
-        # https://support.apple.com/15-inch-macbook-pro-battery-recall
-        program_number.append("062019")
-
-    mbp13SSD = re.compile("(?:MacBook Pro \(13-inch, 2017, Two Thunderbolt 3 ports\))|(?:13-inch Retina MacBook Pro \(Mid 2017\))|(?:MacBookPro11,4)|(?:MacBookPro14,1)")
-    if mbp13SSD.search(str(model)):
-        # 13-inch MacBook Pro (non Touch Bar) Solid-State Drive Service Program
-        # https://support.apple.com/13-inch-macbook-pro-solid-state-drive-service
-        program_number.append("112018")
-
-    mbp13Battery = re.compile("(?:13-inch MacBook Pro \(non Touch Bar\))|(?:13-inch Retina MacBook Pro \(Late 2016\))|(?:13-inch Retina MacBook Pro \(Mid 2017\))|(?:MacBookPro13,1)|(?:MacBookPro14,1)")
-    if mbp13Battery.search(str(model)):
-        # 13-inch MacBook Pro (non Touch Bar) Battery Replacement Program
-        # https://support.apple.com/13inch-macbookpro-battery-replacement
-        program_number.append("032018")
-
-    if model == "iPhone 11":
-        # iPhone 11 Display Module Replacement Program for Touch Issues
-        # https://support.apple.com/iphone-11-display-module-replacement-program
-        program_number.append("122020")
-
-    if model == "iPhone 8":
-        # iPhone 8 Logic Board Replacement Program
-        # https://support.apple.com/iphone-8-logic-board-replacement-program
-        program_number.append("082018")
-
-    if model == "iPhone 6S" or model == "iPhone 6 Plus":
-        # iPhone 6s and iPhone 6s Plus Service Program for No Power Issues
-        # https://support.apple.com/iphone-6s-6s-plus-no-power-issues-program
-        program_number.append("102019")
+    """Returns a tuple of the program numbers available for a model or model identifier.
 
-# Discontinued programs
+    Results are cached per model string, as a fleet only has a handful of distinct models.
+    """
+
+    model = str(model)
+    program_number = PROGRAM_INDEX.get(model)
 
-    # if model == "iPhone 6S":
-    #     # iPhone 6s Program for Unexpected Shutdown Issues
-    #     # https://support.apple.com/iphone6s-unexpectedshutdown
-    #     program_number.append("112016")
+    if program_number is None:
+        program_number = set()
 
-    # if model == "iPhone 6 Plus":
-    #     # iSight Camera Replacement Program for iPhone 6 Plus
-    #     # https://support.apple.com/iphone6plus-isightcamera
-    #     program_number.append("082015")
+        for match in PROGRAM_PATTERN.finditer(model):
+            program_number.update(PROGRAM_INDEX[match.group(0)])
+
+        program_number = tuple(sorted(program_number, key=PROGRAM_ORDER.get))
 
     return program_number
 
 
 # This function takes a serial number and it's model, checks for available exchange programs and the loops through each program ID to check if it's eligible
-def loop(model, serial):
+def loop(model, serial, limiter=None, cache=None, client=None, retry=None, failures=None):
     results = []
 
+    # Default to the historical pace of one request every ten seconds so we don't DDoS Apple!
+    if limiter is None:
+        limiter = RateLimiter(rate=0.1)
+
+    if client is None:
+        client = LookupClient()
+
+    if retry is None:
+        retry = RetryPolicy()
+
     # Check if model has available exchange program
     programs = available_exchange_programs(model)
 
@@ -143,25 +579,827 @@ def loop(model, serial):
     if programs:
         for program in programs:
 
-            # Query Apple's API to see if device is eligible
-            status_code, json_data = exchange_lookup(program, serial, str(uuid.uuid1()))
+            # Use a previous result if one is still valid
+            status = cache.get(serial, program) if cache else None
+
+            if status is None:
+                attempt = 0
+
+                while True:
+                    # Wait for our turn in the request budget
+                    limiter.acquire()
+
+                    # Query Apple's API to see if device is eligible
+                    try:
+                        status_code, json_data = exchange_lookup(program, serial, str(uuid.uuid1()), client)
+                        reason = "HTTP {}".format(status_code)
+                    except (OSError, http.client.HTTPException) as error:
+                        status_code, json_data = None, None
+                        reason = str(error) or type(error).__name__
 
-            # Verify the status code was successful
-            if int(status_code) == 200:
-                # Get the attributes
-                status = json_data["status"]
+                    if not retry.retryable(status_code):
+                        limiter.reward()
+                        break
 
-                # Check if the device is eligible -- if not, move on without track this
-                if status == "E00":
-                    print("{} is eligible for program:  {}".format(serial, program))
-                    results.append(program)
+                    # Slow down and try again, as long as there's budget left
+                    limiter.penalize()
 
-            # Sleep so we don't DDoS Apple!
-            time.sleep(10)
+                    if not retry.allow(attempt):
+                        break
+
+                    time.sleep(retry.delay(attempt))
+                    attempt += 1
+
+                # Verify the status code was successful
+                if status_code == 200 and json_data and json_data.get("status"):
+                    # Get the attributes
+                    status = json_data["status"]
+
+                    if cache:
+                        cache.set(serial, program, status)
+
+                else:
+                    if status_code == 200:
+                        reason = "Unexpected response"
+
+                    if failures:
+                        failures.record(serial, model, program, reason)
+                    else:
+                        print("Failed to look up {} for program {}:  {}".format(serial, program, reason))
+
+            # Check if the device is eligible -- if not, move on without track this
+            if status == "E00":
+                print("{} is eligible for program:  {}".format(serial, program))
+                results.append(program)
 
     return results
 
 
+def lookup_devices(rows, model_fieldname, serial_fieldname, concurrency=1, skip=None, **kwargs):
+    """Looks up a batch of devices concurrently, sharing a single request budget.
+
+    Results are yielded in the same order as the rows were provided and no more than
+    `concurrency` devices are ever in flight, so memory stays flat for large inputs.
+
+    Args:
+        rows:  An iterable of (row number, dict) tuples, e.g. from BatchWriter.pending()
+        model_fieldname:  Key of the model or model identifier in each row
+        serial_fieldname:  Key of the serial number in each row
+        concurrency:  Max number of devices to look up at the same time
+        skip:  Optional function called with the row number and row that returns True if
+            the row does not need to be looked up, e.g. Preflight.skip
+        **kwargs:  Passed to loop(), i.e. the shared limiter, cache, client, retry policy and failure log
+    Returns:
+        generator:  Yields a tuple of (row number, row, results) where results is the
+            return value of loop()
+    """
+
+    concurrency = max(1, concurrency)
+    pending = collections.deque()
+    in_flight = 0
+
+    # Rows that are skipped still wait their turn, but only so many are held at once
+    max_pending = concurrency * 64
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        for row_number, row in rows:
+
+            if skip and skip(row_number, row):
+                pending.append((row_number, row, None))
+
+            else:
+                pending.append((row_number, row, executor.submit(
+                    loop, model=row[model_fieldname], serial=row[serial_fieldname], **kwargs)))
+                in_flight += 1
+
+            # Hand back everything that's finished, in order
+            while pending and ( pending[0][2] is None or pending[0][2].done() ):
+                row_number, row, future = pending.popleft()
+
+                if future:
+                    in_flight -= 1
+
+                yield row_number, row, future.result() if future else []
+
+            # Wait on the oldest lookup once the window is full to keep results in order
+            while in_flight >= concurrency or len(pending) >= max_pending:
+                row_number, row, future = pending.popleft()
+
+                if future:
+                    in_flight -= 1
+
+                yield row_number, row, future.result() if future else []
+
+        while pending:
+            row_number, row, future = pending.popleft()
+            yield row_number, row, future.result() if future else []
+
+
+class Preflight(object):
+    """A fast first pass over the input that is made before any lookups are sent.
+
+    Serial numbers are deduplicated (the first row wins), rows are bucketed by the programs
+    their model is eligible for and rows without an available program are marked to be skipped.
+
+    Args:
+        model_fieldname:  Key of the model or model identifier in each row
+        serial_fieldname:  Key of the serial number in each row
+    """
+
+    def __init__(self, model_fieldname, serial_fieldname):
+        self.model_fieldname = model_fieldname
+        self.serial_fieldname = serial_fieldname
+        self.rows = 0
+        self.ineligible = 0
+        self.duplicates = 0
+        # Each eligible serial number's first row number, programs, lookups, cached results
+        # and whether a previous run completed it
+        self.devices = {}
+
+    def scan(self, rows, cache=None, start_row=0):
+        """Counts the lookups needed for each row.
+
+        Args:
+            rows:  An iterable of (row number, dict) tuples
+            cache:  An optional EligibilityCache; fresh results will not need a lookup
+            start_row:  Rows up to this row number were completed by a previous run
+        """
+
+        for row_number, row in rows:
+            self.rows += 1
+            serial = row[self.serial_fieldname]
+            programs = available_exchange_programs(row[self.model_fieldname])
+
+            if not programs:
+                self.ineligible += 1
+                continue
+
+            if serial in self.devices:
+                self.duplicates += 1
+                continue
+
+            lookups = cached = 0
+
+            if row_number > start_row:
+                for program in programs:
+                    if cache and cache.get(serial, program):
+                        cached += 1
+                    else:
+                        lookups += 1
+
+            self.devices[serial] = (row_number, programs, lookups, cached, row_number <= start_row)
+
+    @classmethod
+    def combine(cls, preflights):
+        """Combines the passes made over each shard of an input, in order.
+
+        Serial numbers that were already seen in an earlier shard are removed from the later
+        shards, so that they're skipped there as well.
+
+        Args:
+            preflights:  A list of Preflight instances, one for each shard
+        Returns:
+            Preflight:  The totals for the whole input
+        """
+
+        combined = cls(preflights[0].model_fieldname, preflights[0].serial_fieldname)
+
+        for preflight in preflights:
+            combined.rows += preflight.rows
+            combined.ineligible += preflight.ineligible
+            combined.duplicates += preflight.duplicates
+
+            for serial in [ serial for serial in preflight.devices if serial in combined.devices ]:
+                del preflight.devices[serial]
+                preflight.duplicates += 1
+                combined.duplicates += 1
+
+            combined.devices.update(preflight.devices)
+
+        return combined
+
+    def track(self, rows, cache=None, start_row=0):
+        """Scans each row as it streams by, for inputs that can only be read once.
+
+        Args:
+            rows:  An iterable of dicts
+            cache:  An optional EligibilityCache; fresh results will not need a lookup
+            start_row:  Rows up to this row number were completed by a previous run
+        Returns:
+            generator:  Yields each row after it's been scanned
+        """
+
+        for row_number, row in enumerate(rows, start=1):
+            self.scan([(row_number, row)], cache=cache, start_row=start_row)
+            yield row
+
+    def skip(self, row_number, row):
+        """Returns True if the row does not need to be looked up."""
+
+        device = self.devices.get(row[self.serial_fieldname])
+        return device is None or device[0] != row_number
+
+    def report(self, rate=0, concurrency=1, projection=True):
+        """Prints a summary of the work ahead and the projected runtime."""
+
+        buckets = collections.Counter(device[1] for device in self.devices.values())
+        lookups = sum(device[2] for device in self.devices.values())
+        cached = sum(device[3] for device in self.devices.values())
+        completed = sum(1 for device in self.devices.values() if device[4])
+
+        print("Rows in input:  {}".format(self.rows))
+        print("  Models without an available program:  {}".format(self.ineligible))
+        print("  Duplicate serial numbers:  {}".format(self.duplicates))
+
+        if completed:
+            print("  Completed by a previous run:  {}".format(completed))
+
+        for programs, count in sorted(buckets.items(), key=lambda bucket: bucket[1], reverse=True):
+            print("  Devices eligible for {}:  {}".format(", ".join(programs), count))
+
+        print("Cached results:  {}".format(cached))
+        print("Lookups required:  {}".format(lookups))
+
+        if not projection:
+            return
+
+        if rate > 0:
+            print("Projected runtime:  {} at {} requests/second".format(
+                datetime.timedelta(seconds=int(lookups / rate)), rate))
+        else:
+            print("Projected runtime:  unknown; with no rate limit, up to {} lookups will be sent at a time".format(
+                concurrency))
+
+
+class JamfProInventory(object):
+    """Reads serial numbers and model identifiers from the computers inventory of a Jamf Pro Server.
+
+    Only the hardware section of each computer is requested.  After the first page, pages are
+    fetched concurrently, but only a few pages ahead of the rows being looked up, so the whole
+    inventory is never held in memory.
+
+    Args:
+        url:  URL of the Jamf Pro Server
+        username:  Jamf Pro account with read access to computers
+        password:  Password for the Jamf Pro account
+        page_size:  Number of computers requested per page
+        concurrency:  Max number of pages fetched at the same time
+        timeout:  Number of seconds to wait on the server before giving up on a request
+    """
+
+    field_names = ["Jamf Pro ID", "Serial Number", "Model Identifier", "Model"]
+
+    def __init__(self, url, username, password, page_size=500, concurrency=4, timeout=30):
+        self.username = username
+        self.password = password
+        self.page_size = page_size
+        self.concurrency = max(1, concurrency)
+        self.client = LookupClient(url, pool_size=self.concurrency, timeout=timeout)
+        self._token = None
+        self._token_expires = 0
+        self._lock = threading.Lock()
+
+    def _get_token(self):
+        """Returns an API token, requesting a new one when it's close to expiring."""
+
+        with self._lock:
+            if self._token and time.time() < self._token_expires - 60:
+                return self._token
+
+            credentials = base64.b64encode("{}:{}".format(self.username, self.password).encode()).decode()
+            status_code, content = self.client.request("POST", JAMF_PRO_API_ENDPOINTS["auth_token"],
+                headers={ "Authorization": "Basic {}".format(credentials), "Accept": "application/json" })
+
+            if status_code != 200:
+                print("Aborting:  Failed to authenticate with the Jamf Pro Server (HTTP {}).".format(status_code))
+                sys.exit(5)
+
+            token = json.loads(content)
+            self._token = token["token"]
+            self._token_expires = calendar.timegm(time.strptime(token["expires"][:19], "%Y-%m-%dT%H:%M:%S"))
+
+            return self._token
+
+    def _get_page(self, page):
+        """Returns the total number of computers and the rows for a page of the inventory."""
+
+        query = urlencode([
+            ("section", "HARDWARE"),
+            ("page", page),
+            ("page-size", self.page_size),
+            ("sort", "id:asc")
+        ])
+
+        status_code, content = self.client.request("GET", "{}?{}".format(JAMF_PRO_API_ENDPOINTS["computers_inventory"], query),
+            headers={ "Authorization": "Bearer {}".format(self._get_token()), "Accept": "application/json" })
+
+        if status_code != 200:
+            print("Aborting:  Failed to read page {} of the computers inventory (HTTP {}).".format(page, status_code))
+            sys.exit(5)
+
+        content = json.loads(content)
+        rows = [
+            {
+                "Jamf Pro ID": computer.get("id"),
+                "Serial Number": ( computer.get("hardware") or {} ).get("serialNumber") or "",
+                "Model Identifier": ( computer.get("hardware") or {} ).get("modelIdentifier") or "",
+                "Model": ( computer.get("hardware") or {} ).get("model") or ""
+            }
+            for computer in content.get("results", [])
+        ]
+
+        return content.get("totalCount", 0), rows
+
+    def rows(self):
+        """Streams the computers in the inventory.
+
+        Returns:
+            generator:  Yields a dict for each computer, with the keys in `field_names`
+        """
+
+        total, rows = self._get_page(0)
+        pages = ( total + self.page_size - 1 ) // self.page_size
+
+        for row in rows:
+            yield row
+
+        pending = collections.deque()
+        next_page = 1
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            while next_page < pages or pending:
+
+                while next_page < pages and len(pending) < self.concurrency:
+                    pending.append(executor.submit(self._get_page, next_page))
+                    next_page += 1
+
+                for row in pending.popleft().result()[1]:
+                    yield row
+
+    def close(self):
+        self.client.close()
+
+
+class BatchWriter(object):
+    """Streams eligible devices to the output CSV as they're confirmed and journals the progress.
+
+    The journal (`<output>.journal`) records the input, and then the last processed row
+    number, its serial number and the size of the output file at that point.  If a run is
+    interrupted, the next run with the same input and output truncates the output back to the
+    last journaled size and skips the rows that were already processed.
+
+    Args:
+        source:  Path to the input CSV, or the URL of the Jamf Pro Server the rows are read from
+        output_file:  Path to the output CSV
+        field_names:  Field names of the input
+        serial_fieldname:  Field name of the serial number column
+        shard:  Optional (start, end) byte range of the input being processed; the output
+            will then be a partial output without a header
+    """
+
+    # Rows without an eligible device are journaled at most this often (in seconds); any rows
+    # that have to be processed again on resume are served from the cache
+    journal_interval = 1
+
+    def __init__(self, source, output_file, field_names, serial_fieldname, shard=None):
+        self.source = source if "://" in source else os.path.abspath(source)
+        self.header = shard is None
+
+        if shard:
+            self.source = "{} [{}-{}]".format(self.source, *shard)
+
+        self.output_file = output_file
+        self.journal_file = "{}.journal".format(output_file)
+        self.field_names = list(field_names) + ["Eligible Programs"]
+        self.serial_fieldname = serial_fieldname
+        self.row_number = 0
+        self.eligible = 0
+        self.csv_out = None
+        self.writer = None
+        self.offset = 0
+        self.journal = None
+        self.resume_row, self.resume_serial, self.resume_offset = self._read_journal()
+        self._journaled = time.monotonic()
+
+    def open(self):
+        """Prepares the output and starts the journal, picking up from the last checkpoint if there is one."""
+
+        if self.resume_row:
+            print("Resuming after row {} of the input.".format(self.resume_row))
+
+            if self.resume_offset and os.path.exists(self.output_file):
+                # Drop anything written after the last checkpoint
+                with open(self.output_file, 'r+') as csv_out:
+                    csv_out.truncate(self.resume_offset)
+                self.offset = self.resume_offset
+                self._open_output(mode='a')
+
+        # Keep the journal, but start it over from the last checkpoint
+        self.journal = open(self.journal_file, mode='w')
+        self.journal.write("{}\n".format(self.source))
+
+        if self.resume_row:
+            self._checkpoint(self.resume_row, self.resume_serial)
+        else:
+            self.journal.flush()
+
+    def _read_journal(self):
+        """Returns the row number, serial number and output size of the last checkpoint."""
+
+        if not os.path.exists(self.journal_file):
+            return 0, None, 0
+
+        with open(self.journal_file, 'r') as journal:
+            journaled_input = journal.readline().rstrip("\n")
+
+            if journaled_input != self.source:
+                print("Ignoring the existing journal as it belongs to a different input.")
+                return 0, None, 0
+
+            # Only the last complete checkpoint matters
+            last_checkpoint = None
+            for line in journal:
+                if line.endswith("\n"):
+                    last_checkpoint = line
+
+        if not last_checkpoint:
+            return 0, None, 0
+
+        row_number, serial, offset = next(csv.reader([last_checkpoint]))
+        return int(row_number), serial, int(offset)
+
+    def _open_output(self, mode='w'):
+        self.csv_out = open(self.output_file, mode=mode, newline='')
+        self.writer = csv.DictWriter(self.csv_out, fieldnames=self.field_names)
+
+        if mode == 'w' and self.header:
+            self.writer.writeheader()
+
+    def _checkpoint(self, row_number, serial):
+        csv.writer(self.journal).writerow([row_number, serial, self.offset])
+        self.journal.flush()
+        self._journaled = time.monotonic()
+
+    def pending(self, rows):
+        """Skips the rows that were processed by a previous run.
+
+        Args:
+            rows:  An iterable of dicts, e.g. a csv.DictReader
+        Returns:
+            generator:  Yields a tuple of (row number, row) for the rows that still need to be looked up
+        """
+
+        for row_number, row in enumerate(rows, start=1):
+
+            if row_number < self.resume_row:
+                continue
+
+            elif row_number == self.resume_row:
+                if row[self.serial_fieldname] != self.resume_serial:
+                    print("Aborting:  The input has changed since the last run; remove {} to start over.".format(
+                        self.journal_file))
+                    sys.exit(4)
+
+                continue
+
+            yield row_number, row
+
+    def write(self, row_number, row, results):
+        """Records the result of the next row, writing it to the output if it's eligible.
+
+        Args:
+            row_number:  The number of the row in the input CSV
+            row:  The row from the input CSV
+            results:  The return value of loop() for the row
+        """
+
+        self.row_number = row_number
+
+        # Verify a result was found, if so, write it out right away
+        if len(results) != 0:
+            if not self.writer:
+                self._open_output()
+
+            row.update({'Eligible Programs': str(list(results)).strip('[]\'')})
+            self.writer.writerow(row)
+            self.csv_out.flush()
+            self.offset = self.csv_out.tell()
+            self.eligible += 1
+
+        if len(results) != 0 or time.monotonic() - self._journaled >= self.journal_interval:
+            self._checkpoint(self.row_number, row[self.serial_fieldname])
+
+    def close(self):
+        """Closes the output and removes the journal now that every row has been processed."""
+
+        if self.csv_out:
+            self.csv_out.close()
+
+        self.journal.close()
+        os.remove(self.journal_file)
+
+
+def process_batch(rows, batch_writer, preflight, model_fieldname, serial_fieldname, concurrency=1, **kwargs):
+    """Looks up each row that still needs it, writing out eligible devices and failures as they're found.
+
+    Args:
+        rows:  An iterable of dicts, e.g. a csv.DictReader
+        batch_writer:  The BatchWriter for the output
+        preflight:  The Preflight that decides which rows are skipped
+        model_fieldname:  Key of the model or model identifier in each row
+        serial_fieldname:  Key of the serial number in each row
+        concurrency:  Max number of devices to look up at the same time
+        **kwargs:  Passed to loop(), i.e. the shared limiter, cache, client and retry policy
+    Returns:
+        FailureLog:  The lookups that failed, recorded to `<output>.failures.csv`
+    """
+
+    batch_writer.open()
+    failures = FailureLog("{}.failures.csv".format(batch_writer.output_file), append=bool(batch_writer.resume_row))
+
+    # Look up each row, in order, within the request budget
+    for row_number, row, results in lookup_devices(batch_writer.pending(rows), model_fieldname, serial_fieldname,
+        concurrency=concurrency, skip=preflight.skip, failures=failures, **kwargs):
+
+        batch_writer.write(row_number, row, results)
+
+    batch_writer.close()
+    failures.close()
+
+    return failures
+
+
+def shard_input(input_file, workers):
+    """Splits an input CSV into byte ranges that each start at the beginning of a row.
+
+    Quotes are counted along the way so that a new line within a quoted value is never used
+    as a boundary.
+
+    Args:
+        input_file:  Path to the input CSV
+        workers:  Number of shards to create
+    Returns:
+        list:  A (start, end) tuple for each shard, in order; the header row is not included
+    """
+
+    size = os.path.getsize(input_file)
+    # The first target finds the end of the header row
+    targets = collections.deque([0] + [ size * shard // workers for shard in range(1, workers) ])
+    boundaries = []
+    in_quotes = 0
+    offset = 0
+
+    with open(input_file, 'rb') as csv_in:
+
+        while targets:
+            block = csv_in.read(1048576)
+
+            if not block:
+                break
+
+            position = 0
+
+            while targets and targets[0] < offset + len(block):
+                target = max(targets[0] - offset, position)
+                in_quotes ^= block.count(b'"', position, target) & 1
+                position = target
+
+                # Look for the next line ending that's outside of a quoted value
+                new_line = block.find(b"\n", position)
+
+                while new_line != -1:
+                    in_quotes ^= block.count(b'"', position, new_line) & 1
+                    position = new_line + 1
+
+                    if not in_quotes:
+                        boundaries.append(offset + position)
+                        targets.popleft()
+                        break
+
+                    new_line = block.find(b"\n", position)
+
+                else:
+                    # Keep looking in the next block
+                    break
+
+            in_quotes ^= block.count(b'"', position) & 1
+            offset += len(block)
+
+    boundaries.append(size)
+    return [ (start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end ]
+
+
+def read_shard(input_file, start, end, field_names):
+    """Reads the rows within a byte range of an input CSV.
+
+    Args:
+        input_file:  Path to the input CSV
+        start:  Offset of the first row, as returned by shard_input()
+        end:  Offset after the last row, as returned by shard_input()
+        field_names:  Field names from the header of the input CSV
+    Returns:
+        generator:  Yields a dict for each row
+    """
+
+    with open(input_file, 'rb') as csv_in:
+        csv_in.seek(start)
+
+        def lines():
+            position = start
+
+            while position < end:
+                line = csv_in.readline()
+
+                if not line:
+                    break
+
+                position += len(line)
+                yield line.decode('utf-8')
+
+        for row in csv.DictReader(lines(), fieldnames=field_names):
+            yield row
+
+
+# The limiter, retry policy, client and cache used by the lookups within each worker process
+_worker = {}
+
+
+def _init_worker(args, limiter, retry, field_names, model_fieldname, serial_fieldname):
+    _worker.update({
+        "args": args,
+        "limiter": limiter,
+        "retry": retry,
+        "client": LookupClient(args.url, pool_size=args.concurrency, timeout=args.timeout),
+        "cache": None if args.no_cache else EligibilityCache(
+            args.cache, ttl=args.cache_ttl * 86400, max_entries=args.cache_max),
+        "field_names": field_names,
+        "model_fieldname": model_fieldname,
+        "serial_fieldname": serial_fieldname
+    })
+
+
+def _preflight_shard(shard):
+    batch_writer = BatchWriter(_worker["args"].input, shard["output_file"], _worker["field_names"],
+        _worker["serial_fieldname"], shard=(shard["start"], shard["end"]))
+    preflight = Preflight(_worker["model_fieldname"], _worker["serial_fieldname"])
+    preflight.scan(enumerate(read_shard(_worker["args"].input, shard["start"], shard["end"], _worker["field_names"]),
+        start=1), cache=_worker["cache"], start_row=batch_writer.resume_row)
+    return preflight
+
+
+def _lookup_shard(shard, preflight):
+
+    try:
+        batch_writer = BatchWriter(_worker["args"].input, shard["output_file"], _worker["field_names"],
+            _worker["serial_fieldname"], shard=(shard["start"], shard["end"]))
+
+        process_batch(read_shard(_worker["args"].input, shard["start"], shard["end"], _worker["field_names"]),
+            batch_writer, preflight, _worker["model_fieldname"], _worker["serial_fieldname"],
+            concurrency=_worker["args"].concurrency, limiter=_worker["limiter"], cache=_worker["cache"],
+            client=_worker["client"], retry=_worker["retry"])
+
+    except SystemExit as error:
+        # Let the main process decide how to exit, rather than losing this worker
+        return error.code, 0, []
+
+    return 0, _worker["client"].requests, _worker["client"].latencies
+
+
+def lookup_shards(args, field_names, model_fieldname, serial_fieldname):
+    """Shards the input CSV across worker processes and merges their partial outputs.
+
+    Each shard is written to `<output>.part<number>` with its own journal, so an interrupted run
+    can be resumed with the same number of workers.  All workers share one request budget.
+
+    Args:
+        args:  The parsed arguments
+        field_names:  Field names from the header of the input CSV
+        model_fieldname:  Field name of the model column
+        serial_fieldname:  Field name of the serial number column
+    Returns:
+        int:  Number of bytes of eligible devices that were written to the output
+    """
+
+    shards = [
+        { "start": start, "end": end, "output_file": "{}.part{}".format(args.output, number) }
+        for number, (start, end) in enumerate(shard_input(args.input, args.workers))
+    ]
+
+    # The input has a header, but no rows
+    if not shards:
+        return 0
+
+    context = multiprocessing.get_context('spawn')
+    limiter = RateLimiter.shared(rate=args.rate, burst=args.burst, context=context)
+    retry = RetryPolicy.shared(budget=args.retry_budget, max_attempts=args.retries + 1, context=context)
+
+    with context.Pool(processes=len(shards), initializer=_init_worker,
+        initargs=(args, limiter, retry, field_names, model_fieldname, serial_fieldname)) as pool:
+
+        # Work out exactly what needs to be looked up before sending anything
+        preflights = pool.map(_preflight_shard, shards)
+        combined = Preflight.combine(preflights)
+        combined.report(rate=args.rate, concurrency=args.concurrency * len(shards))
+
+        if args.dry_run:
+            sys.exit(0)
+
+        started = time.monotonic()
+        results = pool.starmap(_lookup_shard, zip(shards, preflights))
+
+        for exit_code, _, _ in results:
+            if exit_code:
+                sys.exit(exit_code)
+
+    # Stitch the partial outputs back together in the original row order
+    part_files = [ shard["output_file"] for shard in shards if os.path.exists(shard["output_file"]) ]
+    written = sum(os.path.getsize(part_file) for part_file in part_files)
+
+    if written:
+        with open(args.output, mode='w', newline='') as csv_out:
+            csv.DictWriter(csv_out, fieldnames=list(field_names) + ["Eligible Programs"]).writeheader()
+
+            for part_file in part_files:
+                with open(part_file, 'r', newline='') as part:
+                    shutil.copyfileobj(part, csv_out)
+
+    for part_file in part_files:
+        os.remove(part_file)
+
+    # Likewise for the lookups that failed
+    failures = FailureLog("{}.failures.csv".format(args.output))
+    failure_files = [ "{}.failures.csv".format(shard["output_file"]) for shard in shards ]
+
+    for failure_file in [ failure_file for failure_file in failure_files if os.path.exists(failure_file) ]:
+        with open(failure_file, 'r', newline='') as part:
+            for serial, model, program, reason in itertools.islice(csv.reader(part), 1, None):
+                failures.record(serial, model, program, reason)
+
+        os.remove(failure_file)
+
+    failures.close()
+    report_failures(failures, retry)
+
+    if args.stats:
+        write_stats(args.stats, started, combined.rows, sum(result[1] for result in results),
+            [ latency for result in results for latency in result[2] ])
+
+    return written
+
+
+def write_stats(path, started, rows, requests, latencies):
+    """Writes the throughput and lookup latencies of a run to a JSON file.
+
+    Args:
+        path:  Path to the JSON file
+        started:  time.monotonic() from when the lookups started
+        rows:  Number of rows in the input
+        requests:  Number of requests sent to the API
+        latencies:  A sample of request latencies, in seconds
+    """
+
+    elapsed = time.monotonic() - started
+    latencies = sorted(latencies)
+
+    def percentile(percent):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    with open(path, mode='w') as stats_file:
+        json.dump({
+            "rows": rows,
+            "lookups": requests,
+            "elapsed": elapsed,
+            "rows_per_second": rows / elapsed if elapsed else None,
+            "latency_p50": percentile(50),
+            "latency_p99": percentile(99)
+        }, stats_file, indent=4)
+
+
+def report_failures(failures, retry):
+    """Prints a summary of the lookups that failed and the retries that were used."""
+
+    print("Retries used:  {} of {}".format(retry.budget - retry.remaining, retry.budget))
+
+    if failures.count:
+        print("{} lookup(s) failed and were recorded to:  {}".format(failures.count, failures.path))
+        print("To try them again, run:  {} --input \"{}\" --output <path>".format(sys.argv[0], failures.path))
+
+
+def positive_int(value):
+    """Argparse type for options that must be a whole number of at least one."""
+
+    number = int(value)
+
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not {}".format(value))
+
+    return number
+
+
 def main():
 
     ##################################################
@@ -170,14 +1408,52 @@ def main():
     parser = argparse.ArgumentParser(description="Apple Exchange and Repair Extension Programs Lookup")
     single_run = parser.add_argument_group('Single Device')
     batch_run = parser.add_argument_group('Batch Process')
+    jamf_run = parser.add_argument_group('Jamf Pro Inventory')
 
     single_run.add_argument('--serialnumber', '-s', metavar='C02LA1K9G7DM', type=str, help='A single serial number', required=False)
     single_run.add_argument('--model', '-m', metavar='MacBookPro11,4', type=str, help='A model or model identifier. \
     Example:  MacBook Pro (Retina, 15-inch, Mid 2015) or 15-inch Retina MacBook Pro (Mid 2015) or MacBookPro11,4', required=False)
     batch_run.add_argument('--input', '-i', metavar='/path/to/input_file.csv', type=str, help='Path to a CSV with a list of serial numbers, and models or model identifiers. \
     Example:  MacBook Pro (Retina, 15-inch, Mid 2015) or 15-inch Retina MacBook Pro (Mid 2015) or MacBookPro11,4', required=False)
+    jamf_run.add_argument('--jamf', '-j', metavar='https://jps.company.com:8443', type=str, help='Read serial numbers and \
+    model identifiers from the computers inventory of a Jamf Pro Server, instead of --input.', required=False)
+    jamf_run.add_argument('--jamf-username', metavar='api_account', type=str, help='Jamf Pro account with \
+    read access to computers.  Will be prompted for if not provided.', required=False)
+    jamf_run.add_argument('--jamf-password', metavar='password', type=str, help='Password for the Jamf Pro account.  \
+    Will be prompted for if not provided.', required=False)
+    jamf_run.add_argument('--jamf-page-size', metavar='500', type=int, default=500, help='Number of computers \
+    requested per page.  Default:  500', required=False)
     batch_run.add_argument('--output', '-o', metavar='/path/to/output_file.csv', type=str, help='Path to a CSV where devices that are eligible for a repair will be written. \
+    Progress is journaled next to it so an interrupted run can be resumed by running the same command again. \
     WARNING:  If the files exists, it will be overwritten!', required=False)
+    parser.add_argument('--rate', '-r', metavar='0.1', type=float, default=0.1, help='Max number of requests per second \
+    that will be sent to Apple.  Use 0 to disable the limit.  Default:  0.1 (one request every ten seconds)', required=False)
+    parser.add_argument('--burst', metavar='1', type=positive_int, default=1, help='Number of requests that can be sent \
+    back-to-back before the rate limit applies.  Default:  1', required=False)
+    batch_run.add_argument('--dry-run', action='store_true', help='Only report the number of lookups required \
+    and the projected runtime.', required=False)
+    batch_run.add_argument('--concurrency', '-c', metavar='4', type=positive_int, default=4, help='Max number of devices \
+    that will be looked up at the same time, by each worker.  Default:  4', required=False)
+    batch_run.add_argument('--workers', '-w', metavar='1', type=positive_int, default=1, help='Number of processes the input \
+    will be split across.  All workers share the same rate limit.  Default:  1', required=False)
+    parser.add_argument('--timeout', metavar='30', type=float, default=30, help='Number of seconds to wait on \
+    Apple before a lookup fails.  Default:  30', required=False)
+    parser.add_argument('--retries', metavar='4', type=int, default=4, help='Max number of times a failed \
+    or throttled lookup is retried, with exponential backoff.  Default:  4', required=False)
+    parser.add_argument('--retry-budget', metavar='100', type=int, default=100, help='Max number of retries \
+    for the whole run.  Once spent, failed lookups are recorded to <output>.failures.csv.  Default:  100', required=False)
+    parser.add_argument('--url', metavar=QUALITY_PROGRAMS_URL, type=str, default=QUALITY_PROGRAMS_URL,
+        help='Base URL of the quality programs API, e.g. a local stand-in for testing.  Default:  %(default)s', required=False)
+    parser.add_argument('--stats', metavar='/path/to/stats.json', type=str, help='Path to a JSON file where \
+    the number of rows, lookups, the elapsed time and lookup latencies of the run will be written.', required=False)
+    parser.add_argument('--cache', metavar='/path/to/cache.sqlite', type=str,
+        default=os.path.expanduser('~/Library/Caches/Apple_RepairPrograms.sqlite'),
+        help='Path to a database where lookup results are cached between runs.  Default:  %(default)s', required=False)
+    parser.add_argument('--cache-ttl', metavar='7', type=float, default=7, help='Number of days a cached result \
+    is reused before Apple is asked again.  Default:  7', required=False)
+    parser.add_argument('--cache-max', metavar='250000', type=int, default=250000, help='Max number of results \
+    kept in the cache; the oldest are evicted first.  Default:  250000', required=False)
+    parser.add_argument('--no-cache', action='store_true', help='Do not read or write cached results.', required=False)
     # parser.add_argument('--quiet', '-q', action='store_true', help='Do not print verbose messages.', required=False)
 
     args = parser.parse_args()
@@ -193,7 +1469,11 @@ def main():
         parser.print_help()
         sys.exit(0)
     else:
-        if ( args.input or args.output ) and ( args.serialnumber or args.model ):
+        if ( args.input or args.jamf or args.output ) and ( args.serialnumber or args.model ):
+            parser.print_help()
+            parser.exit(status=1, message='\nError:  Unable to mix arguments between parameter groups.\n')
+
+        if args.input and args.jamf:
             parser.print_help()
             parser.exit(status=1, message='\nError:  Unable to mix arguments between parameter groups.\n')
 
@@ -202,17 +1482,31 @@ def main():
         # else:
         #     verbose = True
 
+        # All lookups share the same request budget
+        limiter = RateLimiter(rate=args.rate, burst=args.burst)
+
+        # Failed requests are retried with backoff, until the run's retry budget is spent
+        retry = RetryPolicy(budget=args.retry_budget, max_attempts=args.retries + 1)
+
+        # Connections to Apple are kept open and reused for every lookup
+        client = LookupClient(args.url, pool_size=args.concurrency, timeout=args.timeout)
+
+        # Previous results are reused until they expire
+        if args.no_cache or not ( ( ( args.input or args.jamf ) and args.output ) or ( args.serialnumber and args.model ) ):
+            cache = None
+        else:
+            cache = EligibilityCache(args.cache, ttl=args.cache_ttl * 86400, max_entries=args.cache_max)
+
         # If working with a csv...
         if args.input and args.output:
             input_file = args.input
             output_file = args.output
-            eligible_devices = []
             serial_fieldname = None
             model_fieldname = None
 
             if os.path.exists(input_file):
                 # Open the provided CSV file
-                with open(input_file, 'r') as csv_in:
+                with open(input_file, 'r', newline='') as csv_in:
                     csv_reader = csv.DictReader(csv_in, delimiter=',')
 
                     # Get the field names so we can parse these for the fields we need as well as use for writing back out later
@@ -234,50 +1528,109 @@ def main():
                         print("Aborting:  Unable to correlate the header columns in the CSV file to expected values.")
                         sys.exit(3)
 
-                    # Loop through each row in the CSV file
-                    for row in csv_reader:
+                    # Very large inputs can be split across processes
+                    if args.workers > 1:
+                        if cache:
+                            cache.close()
 
-                        # Pass each row attributes to the loop function
-                        results = loop(model=row[model_fieldname], serial=row[serial_fieldname])
+                        client.close()
 
-                        # Verify a result was found, if so, add it to a tracking list
-                        if len(results) != 0:
-                            row.update({'Eligible Programs': str(results).strip('[]\'')})
-                            eligible_devices.append(row)
+                        if not lookup_shards(args, field_names, model_fieldname, serial_fieldname):
+                            print('None of the devices provided were eligible for a recall program.')
 
-                        # if len(eligible_devices) == 2:
-                        #     break
+                        sys.exit(0)
 
-                    # Check if any devices were eligible before doing anything else
-                    if len(eligible_devices) > 0:
+                    # Eligible devices are written out as they're found; an interrupted run picks up where it left off
+                    batch_writer = BatchWriter(input_file, output_file, field_names, serial_fieldname)
 
-                        # Write to the CSV specified, if it exists, it will be overwritten
-                        with open(output_file, mode='w') as csv_out:
+                    # Work out exactly what needs to be looked up before sending anything
+                    preflight = Preflight(model_fieldname, serial_fieldname)
+                    preflight.scan(enumerate(csv_reader, start=1), cache=cache, start_row=batch_writer.resume_row)
+                    preflight.report(rate=args.rate, concurrency=args.concurrency)
 
-                            # Build our new header...
-                            header_line = field_names
-                            header_line.append("Eligible Programs")
-                            writer = csv.DictWriter(csv_out, fieldnames=header_line)
-                            writer.writeheader()
+                    if args.dry_run:
+                        sys.exit(0)
 
-                            for device in eligible_devices:
-                                writer.writerow(device)
-                    else:
+                    csv_in.seek(0)
+                    csv_reader = csv.DictReader(csv_in, delimiter=',')
+                    started = time.monotonic()
+
+                    failures = process_batch(csv_reader, batch_writer, preflight, model_fieldname, serial_fieldname,
+                        concurrency=args.concurrency, limiter=limiter, cache=cache, client=client, retry=retry)
+                    report_failures(failures, retry)
+
+                    if args.stats:
+                        write_stats(args.stats, started, preflight.rows, client.requests, client.latencies)
+
+                    # Check if any devices were eligible
+                    if batch_writer.eligible == 0 and batch_writer.offset == 0:
                         print('None of the devices provided were eligible for a recall program.')
+
+                        if cache:
+                            cache.close()
+
+                        client.close()
                         sys.exit(0)
-                        
+
+        # If pulling devices from Jamf Pro...
+        elif args.jamf and args.output:
+
+            if args.workers > 1:
+                parser.exit(status=1, message='\nError:  --workers is only supported with --input.\n')
+
+            inventory = JamfProInventory(
+                args.jamf,
+                args.jamf_username or input("Jamf Pro username:  "),
+                args.jamf_password or getpass.getpass("Jamf Pro password:  "),
+                page_size=args.jamf_page_size,
+                concurrency=args.concurrency,
+                timeout=args.timeout
+            )
+
+            batch_writer = BatchWriter(args.jamf, args.output, inventory.field_names, "Serial Number")
+            preflight = Preflight("Model Identifier", "Serial Number")
+
+            # The inventory is only read once, so the pre-flight report comes at the end,
+            # unless this is a dry run
+            if args.dry_run:
+                preflight.scan(enumerate(inventory.rows(), start=1), cache=cache, start_row=batch_writer.resume_row)
+                preflight.report(rate=args.rate, concurrency=args.concurrency)
+                sys.exit(0)
+
+            started = time.monotonic()
+
+            failures = process_batch(
+                preflight.track(inventory.rows(), cache=cache, start_row=batch_writer.resume_row),
+                batch_writer, preflight, "Model Identifier", "Serial Number",
+                concurrency=args.concurrency, limiter=limiter, cache=cache, client=client, retry=retry)
+
+            inventory.close()
+            preflight.report(projection=False)
+            report_failures(failures, retry)
+
+            if args.stats:
+                write_stats(args.stats, started, preflight.rows, client.requests, client.latencies)
+
+            if batch_writer.eligible == 0 and batch_writer.offset == 0:
+                print('None of the devices provided were eligible for a recall program.')
+
         elif args.serialnumber and args.model:
             # A single serial number and model were provided
             input_serialnumber = args.serialnumber
             input_model = args.model
 
             # Pass attributes to the loop function
-            loop(model=input_model, serial=input_serialnumber)
+            loop(model=input_model, serial=input_serialnumber, limiter=limiter, cache=cache, client=client, retry=retry)
 
         else:
             parser.print_help()
             parser.exit(status=1, message='\nError:  Not enough arguments provided.\n')
 
+        if cache:
+            cache.close()
+
+        client.close()
+
 
 if __name__ == "__main__":
     main()
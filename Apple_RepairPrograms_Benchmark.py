@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+###################################################################################################
+# Script Name:  Apple_RepairPrograms_Benchmark.py
+# By:  Zack Thompson / Created:  10/18/2026
+# Version:  1.1.0 / Updated:  10/18/2026 / By:  ZT
+#
+# Description:  This script measures the performance of Apple_RepairPrograms.py without having
+#   to query Apple's API.
+#
+#   rules:  Times the model to exchange program lookup against the previous regex based checks.
+#   pipeline:  Runs Apple_RepairPrograms.py against a local stand-in for Apple's API over synthetic
+#       inputs and reports rows/sec, lookup latency and peak memory for each execution mode.
+#   server:  Only runs the local stand-in for Apple's API, for manual testing.
+#
+###################################################################################################
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Apple_RepairPrograms
+
+
+# A sample of the values found in the model columns of a typical fleet export
+SAMPLE_MODELS = [
+    "MacBookPro11,4",
+    "MacBookPro11,5",
+    "MacBookPro13,1",
+    "MacBookPro14,1",
+    "MacBookPro16,1",
+    "MacBookPro18,3",
+    "MacBookAir10,1",
+    "Macmini9,1",
+    "iMac21,1",
+    "MacBook Pro (Retina, 15-inch, Mid 2015)",
+    "13-inch Retina MacBook Pro (Mid 2017)",
+    "MacBook Pro (13-inch, M1, 2020)",
+    "MacBook Air (M1, 2020)",
+    "iPhone 6S",
+    "iPhone 8",
+    "iPhone 11",
+    "iPhone 11 Pro",
+    "iPhone 13",
+    "iPad (9th generation)",
+    ""
+]
+
+
+# The execution modes that are compared, as extra arguments to Apple_RepairPrograms.py
+EXECUTION_MODES = {
+    "sequential": [ "--concurrency", "1" ],
+    "threaded": [ "--concurrency", "{concurrency}" ],
+    "workers": [ "--concurrency", "{concurrency}", "--workers", "{workers}" ]
+}
+
+
+def legacy_available_exchange_programs(model):
+    """The regex and equality checks used before the exchange program table, kept for comparison."""
+
+    program_number = []
+
+    mbp15Battery = re.compile(r"(?:MacBook Pro \(Retina, 15-inch, Mid 2015\))|(?:15-inch Retina MacBook Pro \(Mid 2015\))|(?:MacBookPro11,4)|(?:MacBookPro11,5)")
+    if mbp15Battery.search(str(model)):
+        program_number.append("062019")
+
+    mbp13SSD = re.compile(r"(?:MacBook Pro \(13-inch, 2017, Two Thunderbolt 3 ports\))|(?:13-inch Retina MacBook Pro \(Mid 2017\))|(?:MacBookPro11,4)|(?:MacBookPro14,1)")
+    if mbp13SSD.search(str(model)):
+        program_number.append("112018")
+
+    mbp13Battery = re.compile(r"(?:13-inch MacBook Pro \(non Touch Bar\))|(?:13-inch Retina MacBook Pro \(Late 2016\))|(?:13-inch Retina MacBook Pro \(Mid 2017\))|(?:MacBookPro13,1)|(?:MacBookPro14,1)")
+    if mbp13Battery.search(str(model)):
+        program_number.append("032018")
+
+    if model == "iPhone 11":
+        program_number.append("122020")
+
+    if model == "iPhone 8":
+        program_number.append("082018")
+
+    if model == "iPhone 6S" or model == "iPhone 6 Plus":
+        program_number.append("102019")
+
+    return program_number
+
+
+def time_function(function, models):
+    """Calls a function once for each model and returns the elapsed seconds and the results."""
+
+    start = time.perf_counter()
+    results = [ function(model) for model in models ]
+    return time.perf_counter() - start, results
+
+
+def benchmark_rules(rows, seed):
+    """Compares the legacy checks with the indexed exchange program lookup."""
+
+    random.seed(seed)
+    models = [ random.choice(SAMPLE_MODELS) for _ in range(rows) ]
+
+    # Compare against the uncached lookup as well, so the index itself is measured
+    Apple_RepairPrograms.available_exchange_programs.cache_clear()
+    uncached = Apple_RepairPrograms.available_exchange_programs.__wrapped__
+
+    legacy_time, legacy_results = time_function(legacy_available_exchange_programs, models)
+    uncached_time, uncached_results = time_function(uncached, models)
+    indexed_time, indexed_results = time_function(Apple_RepairPrograms.available_exchange_programs, models)
+
+    if not ( [ tuple(result) for result in legacy_results ] == uncached_results == indexed_results ):
+        print("Error:  The indexed lookup returned different programs than the legacy checks!")
+        sys.exit(1)
+
+    print("Rows:  {}".format(rows))
+
+    for label, elapsed in (
+        ("Legacy regex checks", legacy_time),
+        ("Indexed lookup (uncached)", uncached_time),
+        ("Indexed lookup", indexed_time)
+    ):
+        print("{:<28}{:>10.4f}s {:>14,.0f} rows/sec {:>8.1f}x".format(
+            label, elapsed, rows / elapsed, legacy_time / elapsed))
+
+
+def mock_server(latency=0.05, jitter=0.5, error_rate=0.0, throttle_rate=0.0, eligible_rate=0.1, port=0):
+    """Starts a local stand-in for Apple's `snlookup/{program}` endpoint in a background thread.
+
+    Args:
+        latency:  Mean number of seconds to wait before each response
+        jitter:  Fraction of the latency that each response may randomly vary by
+        error_rate:  Fraction of requests that fail with a 503
+        throttle_rate:  Fraction of requests that are throttled with a 429
+        eligible_rate:  Fraction of serial numbers that are reported as eligible
+        port:  Port to listen on; 0 picks a free port
+    Returns:
+        ThreadingHTTPServer:  The running server; its URL is http://127.0.0.1:<server_port>
+    """
+
+    class QualityProgramsHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Send each response without waiting on the client to acknowledge the headers
+        disable_nagle_algorithm = True
+
+        def respond(self, status_code, content):
+            content = json.dumps(content).encode()
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            time.sleep(max(0, random.uniform(latency * (1 - jitter), latency * (1 + jitter))))
+
+            if not self.path.startswith("/snlookup/"):
+                return self.respond(404, { "error": "Not found" })
+
+            chance = random.random()
+
+            if chance < error_rate:
+                return self.respond(503, { "error": "Service unavailable" })
+
+            if chance < error_rate + throttle_rate:
+                return self.respond(429, { "error": "Too many requests" })
+
+            # The same serial number always gets the same answer
+            eligible = random.Random(body.get("serial")).random() < eligible_rate
+            self.respond(200, { "status": "E00" if eligible else "E99" })
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), QualityProgramsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def generate_csv(path, rows, seed=0, duplicate_rate=0.01):
+    """Writes a synthetic fleet export with serial number and model identifier columns."""
+
+    generator = random.Random(seed)
+    serials = []
+
+    with open(path, mode='w', newline='') as csv_out:
+        writer = csv.writer(csv_out)
+        writer.writerow([ "Serial Number", "Model Identifier", "Asset Tag" ])
+
+        for row in range(rows):
+            if serials and generator.random() < duplicate_rate:
+                serial = generator.choice(serials)
+            else:
+                serial = "".join(generator.choice(string.ascii_uppercase + string.digits) for _ in range(12))
+                # Only a sample is needed to create duplicates
+                if len(serials) < 10000:
+                    serials.append(serial)
+
+            writer.writerow([ serial, generator.choice(SAMPLE_MODELS), "TAG{:07d}".format(row) ])
+
+
+def run_mode(mode, input_file, url, concurrency, workers, working_directory):
+    """Runs Apple_RepairPrograms.py for one execution mode.
+
+    Returns:
+        dict:  The stats written by the run, plus its peak RSS in MB and the failed lookups
+    """
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Apple_RepairPrograms.py")
+    output_file = os.path.join(working_directory, "{}.csv".format(mode))
+    stats_file = os.path.join(working_directory, "{}.json".format(mode))
+    mode_args = [ arg.format(concurrency=concurrency, workers=workers) for arg in EXECUTION_MODES[mode] ]
+
+    process = subprocess.Popen(
+        [ sys.executable, script, "--input", input_file, "--output", output_file, "--url", url,
+            "--rate", "0", "--no-cache", "--stats", stats_file ] + mode_args,
+        stdout=subprocess.DEVNULL
+    )
+
+    # wait4() reports the resources used by this run alone
+    _, exit_status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(exit_status)
+
+    if process.returncode != 0:
+        print("Error:  The {} run exited with code {}".format(mode, process.returncode))
+        sys.exit(1)
+
+    with open(stats_file, 'r') as stats:
+        results = json.load(stats)
+
+    # ru_maxrss is in bytes on macOS, but kilobytes on Linux
+    results["peak_rss"] = usage.ru_maxrss / ( 1048576 if sys.platform == "darwin" else 1024 )
+
+    failures_file = "{}.failures.csv".format(output_file)
+    results["failures"] = 0
+
+    if os.path.exists(failures_file):
+        with open(failures_file, 'r', newline='') as failures:
+            results["failures"] = sum(1 for _ in failures) - 1
+
+    return results
+
+
+def benchmark_pipeline(args):
+    """Runs each execution mode over synthetic inputs of each size against the local stand-in."""
+
+    server = mock_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate, eligible_rate=args.eligible_rate)
+    url = "http://127.0.0.1:{}".format(server.server_port)
+
+    print("Stand-in API:  {} (latency {}s, errors {:.0%}, throttled {:.0%})".format(
+        url, args.latency, args.error_rate, args.throttle_rate))
+    print("{:<12}{:>10}{:>10}{:>12}{:>12}{:>10}{:>10}{:>12}{:>10}".format(
+        "Mode", "Rows", "Lookups", "Elapsed", "Rows/sec", "p50 ms", "p99 ms", "Peak RSS", "Failed"))
+
+    with tempfile.TemporaryDirectory() as working_directory:
+
+        for rows in args.rows:
+            input_file = os.path.join(working_directory, "input_{}.csv".format(rows))
+            generate_csv(input_file, rows, seed=args.seed)
+
+            for mode in args.modes:
+                results = run_mode(mode, input_file, url, args.concurrency, args.workers, working_directory)
+
+                print("{:<12}{:>10}{:>10}{:>11.2f}s{:>12,.0f}{:>10}{:>10}{:>10.1f}MB{:>10}".format(
+                    mode, results["rows"], results["lookups"], results["elapsed"], results["rows_per_second"] or 0,
+                    "-" if results["latency_p50"] is None else "{:.1f}".format(results["latency_p50"] * 1000),
+                    "-" if results["latency_p99"] is None else "{:.1f}".format(results["latency_p99"] * 1000),
+                    results["peak_rss"], results["failures"]))
+
+    server.shutdown()
+
+
+def main():
+
+    ##################################################
+    # Define Script Parameters
+
+    parser = argparse.ArgumentParser(description="Apple Exchange and Repair Extension Programs Lookup Benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    rules = subparsers.add_parser('rules', help='Time the model to exchange program lookup.')
+    rules.add_argument('--rows', metavar='100000', type=int, default=100000, help='Number of models to look up.  Default:  100000')
+    rules.add_argument('--seed', metavar='0', type=int, default=0, help='Seed for the random model list.  Default:  0')
+
+    pipeline = subparsers.add_parser('pipeline', help='Time each execution mode against a local stand-in for Apple\'s API.')
+    pipeline.add_argument('--rows', metavar='1000', type=int, nargs='+', default=[1000, 10000],
+        help='Number of rows in each synthetic input, e.g. 1000 100000 1000000.  Default:  1000 10000')
+    pipeline.add_argument('--modes', metavar='threaded', nargs='+', choices=list(EXECUTION_MODES),
+        default=list(EXECUTION_MODES), help='Execution modes to run:  {}.  Default:  all'.format(", ".join(EXECUTION_MODES)))
+    pipeline.add_argument('--concurrency', metavar='16', type=int, default=16, help='Concurrency for the threaded and workers modes.  Default:  16')
+    pipeline.add_argument('--workers', metavar='4', type=int, default=4, help='Number of workers for the workers mode.  Default:  4')
+    pipeline.add_argument('--seed', metavar='0', type=int, default=0, help='Seed for the synthetic inputs.  Default:  0')
+
+    server = subparsers.add_parser('server', help='Only run the local stand-in for Apple\'s API.')
+    server.add_argument('--port', metavar='8080', type=int, default=8080, help='Port to listen on.  Default:  8080')
+
+    for subparser in (pipeline, server):
+        subparser.add_argument('--latency', metavar='0.01', type=float, default=0.01, help='Mean response time in seconds.  Default:  0.01')
+        subparser.add_argument('--jitter', metavar='0.5', type=float, default=0.5, help='Fraction the response time varies by.  Default:  0.5')
+        subparser.add_argument('--error-rate', metavar='0.0', type=float, default=0.0, help='Fraction of requests that fail with a 503.  Default:  0.0')
+        subparser.add_argument('--throttle-rate', metavar='0.0', type=float, default=0.0, help='Fraction of requests that are throttled with a 429.  Default:  0.0')
+        subparser.add_argument('--eligible-rate', metavar='0.1', type=float, default=0.1, help='Fraction of serial numbers reported as eligible.  Default:  0.1')
+
+    args = parser.parse_args()
+
+    ##################################################
+    # Bits Staged
+
+    if args.benchmark == 'rules':
+        benchmark_rules(args.rows, args.seed)
+
+    elif args.benchmark == 'pipeline':
+        benchmark_pipeline(args)
+
+    elif args.benchmark == 'server':
+        server = mock_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate, eligible_rate=args.eligible_rate, port=args.port)
+        print("Stand-in API listening on:  http://127.0.0.1:{}".format(server.server_port))
+        print("Use with:  Apple_RepairPrograms.py --url http://127.0.0.1:{} ...".format(server.server_port))
+
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+
+    else:
+        parser.print_help()
+        parser.exit(status=1, message='\nError:  A benchmark must be specified.\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@
 """
 Script Name:  Collect-Diagnostics.py
 By:  Zack Thompson / Created:  8/22/2019
-Version:  1.10.0 / Updated:  12/4/2023 By:  ZT
+Version:  1.11.0 / Updated:  10/18/2026 By:  ZT
 
 Description:  This script allows you to upload a compressed
 	zip of specified files to a computers' inventory record.
@@ -11,39 +11,94 @@ Description:  This script allows you to upload a compressed
 """
 
 import argparse
+import bz2
 import csv
 import datetime
+import fnmatch
+import hashlib
+import io
 import json
 import logging
+import math
 import mimetypes
 import os
 import plistlib
 import re
 import shlex
+import signal
+import stat
 import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import uuid
 import zipfile
+import zlib
 
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext, suppress
 from typing import Union
 
-import objc
-import requests
-
-from cryptography.fernet import Fernet
-from Foundation import NSBundle, NSString
+# objc, Foundation, requests, cryptography and urllib.request are slow to load, so they are
+# imported by the functions that use them, and options like --help do not wait on them
 
 
 CLASSIC_API_ENDPOINTS = {
 	"computers_by_udid": "JSSResource/computers/udid",
+	"computers_by_udid_general": "JSSResource/computers/udid/{udid}/subset/General",
+}
+
+JAMF_PLIST = "/Library/Preferences/com.jamfsoftware.jamf.plist"
+
+LOG_BINARY = "/usr/bin/log"
+
+# File types that are already compressed and are stored in the archive as-is
+INCOMPRESSIBLE_EXTENSIONS = {
+	".7z", ".aar", ".bz2", ".dmg", ".gz", ".heic", ".jpeg", ".jpg", ".lz4", ".mov", ".mp3",
+	".mp4", ".pkg", ".png", ".tbz", ".tgz", ".xip", ".xz", ".zip", ".zst"
+}
+
+# File types that are known to be text and are compressed without sampling them first
+TEXT_EXTENSIONS = { ".csv", ".log", ".plist", ".txt" }
+
+TEXT_CODECS = {
+	"deflate": zipfile.ZIP_DEFLATED,
+	"bzip2": zipfile.ZIP_BZIP2
 }
 
 PRO_API_ENDPOINTS = {
 	"auth_details": "api/v1/auth",
 	"auth_token": "api/v1/auth/token",
+	"auth_keep_alive": "api/v1/auth/keep-alive",
 	"computer_attachments": "api/v1/computers-inventory/{id}/attachments"
 }
 
+# Commands whose output is collected with the default files.  They run in the background
+# while files are archived and are stopped after their timeout (in seconds).
+COMMAND_COLLECTORS = {
+	"installed_profiles": {
+		"command": '/usr/bin/profiles show -cached --output "stdout-xml"',
+		"arcname": "private/tmp/installed_profiles.xml",
+		"timeout": 60
+	},
+	"apns_status": {
+		"command": "/System/Library/PrivateFrameworks/ApplePushService.framework/apsctl status",
+		"arcname": "private/tmp/apns_status.txt",
+		"timeout": 30
+	}
+}
+
+# How much of the unified log is collected with --unified-log, unless a time window is given
+UNIFIED_LOG_COLLECTOR = {
+	"arcname": "private/tmp/unified_log.txt",
+	"last": "1h",
+	"timeout": 300,
+	"max_bytes": 100000000
+}
+
 
 ####################################################################################################
 # Common Helper Functions
@@ -87,217 +142,1673 @@ def decrypt_string(key, encrypted_string):
 		The unencrypted string as a str.
 	"""
 
+	from cryptography.fernet import Fernet
+
 	f = Fernet(key.encode())
 	decrypted_string = f.decrypt(encrypted_string.encode())
 
 	return decrypted_string.decode()
 
 
-def execute_process(command, input=None):
-	"""
-	A helper function for subprocess.
+def unified_log_command(predicate=None, since=None, last=None):
+	"""Build the command line that shows the unified log.
+
+	Args:
+		predicate (str, optional): Only show the entries matching this `log` predicate,
+			e.g. 'subsystem == "com.apple.ManagedClient"'.  Defaults to None.
+		since (datetime, optional): Show the entries logged at or after this time.
+			Defaults to None.
+		last (str, optional): Show the entries logged within this long ago, in the
+			format `log` accepts, e.g. 30m or 2h; ignored if since is provided.
+			Defaults to None, i.e. the entire log.
+	Returns:
+		str:  The command line
+	"""
+
+	command = [LOG_BINARY, "show", "--style", "syslog", "--info"]
+
+	if since:
+		command.extend(["--start", f"{since:%Y-%m-%d %H:%M:%S}"])
+
+	elif last:
+		command.extend(["--last", last])
+
+	if predicate:
+		command.extend(["--predicate", predicate])
+
+	return shlex.join(command)
+
+
+def db_connect(database):
+	"""A helper function to open a database read-only.
+
+	The database is opened as immutable, so SQLite neither takes locks nor creates
+	journal files next to it.
+
+	Args:
+		database (str):  Path to a database that can be opened with sqlite
+	Returns:
+		sqlite3.Connection:  The connection
+	"""
+
+	from urllib.request import pathname2url
+
+	return sqlite3.connect(
+		f"file:{pathname2url(os.path.abspath(database))}?mode=ro&immutable=1", uri=True)
+
+
+def db_table_reader(connection, table, where=None, limit=None, batch_size=1000):
+	"""A helper function to read the contents of a database table as csv.
+
+	The query is run straight away, so errors are raised here, but rows are only
+	fetched in batches as the csv is read, so the table is never held in memory.
+
+	Args:
+		connection (sqlite3.Connection):  An open database connection
+		table (str):  A table in the database to select
+		where (str, optional):  A filter for the rows to select.  Defaults to None.
+		limit (int, optional):  The most rows to select.  Defaults to None.
+		batch_size (int, optional):  Rows to fetch at a time.  Defaults to 1000.
+	Returns:
+		generator:  Yields the table as csv, a batch of rows at a time
+	"""
+
+	table = table.replace('"', '""')
+	query = f'select * from "{table}"'
+	parameters = []
+
+	if where:
+		query += f" where {where}"
+
+	if limit:
+		query += " limit ?"
+		parameters.append(limit)
+
+	cursor = connection.execute(query, parameters)
+
+	def rows_to_csv():
+
+		buffer = io.StringIO()
+		csv_out = csv.writer(buffer)
+		# Write header
+		csv_out.writerow([description[0] for description in cursor.description])
+
+		# Write data
+		while rows := cursor.fetchmany(batch_size):
+			csv_out.writerows(rows)
+			yield buffer.getvalue().encode()
+			buffer.seek(0)
+			buffer.truncate()
+
+		yield buffer.getvalue().encode()
+
+	return rows_to_csv()
+
+
+def get_system_info():
+	"""
+	A helper function to get specific system attributes.
+
+	Credit:  Mikey Mike/Froger/Pudquick/etc
+	Source:  https://gist.github.com/pudquick/c7dd1262bd81a32663f0
+	Notes:  Modified from source
+
+	Args:
+		attribute:  The system attribute desired.
+
+	Returns:
+		stdout:  The system attribute value.
+	"""
+
+	import objc
+
+	from Foundation import NSBundle, NSString
+
+	IOKit_bundle = NSBundle.bundleWithIdentifier_("com.apple.framework.IOKit")
+	functions = [
+		("IORegistryEntryCreateCFProperty", b"@I@@I"),
+		("IOServiceGetMatchingService", b"II@"),
+		("IOServiceMatching", b"@*")
+	]
+	objc.loadBundleFunctions(IOKit_bundle, globals(), functions)
+
+	def io_key(key_name, service_name="IOPlatformExpertDevice"):
+		service = IOServiceMatching(service_name.encode("utf-8"))
+		key = NSString.stringWithString_(key_name)
+		return IORegistryEntryCreateCFProperty(
+			IOServiceGetMatchingService(0, service), key, None, 0)
+
+	def get_hardware_uuid():
+		return io_key("IOPlatformUUID")
+
+	# def get_hardware_serial():
+	# 	return io_key("IOPlatformSerialNumber")
+
+	# def get_board_id():
+	# 	try:
+	# 		return bytes(io_key("board-id")).decode().rstrip("\x00")
+	# 	except TypeError:
+	# 		return ""
+
+	# def get_model_id():
+	# 	return bytes(io_key("model")).decode().rstrip("\x00")
+
+	# def lookup_model(lookup_code):
+	# 	xml = requests.get(f"https://support-sp.apple.com/sp/product?cc={lookup_code}").text
+
+	# 	try:
+	# 		tree = ElementTree.fromstringlist(xml)
+	# 		return tree.find(".//configCode").text
+
+	# 	except ElementTree.ParseError as err:
+	# 		log.info(f"Failed to retrieve model name:  {err.strerror}")
+	# 		return ""
+
+
+	# serial_number = get_hardware_serial()
+	# sn_length = len(serial_number)
+	# model = ""
+
+	# if sn_length == 10:
+	# 	results = execute_process("/usr/sbin/ioreg -arc IOPlatformDevice -k product-name")
+
+	# 	if results.get("success"):
+	# 		plist_contents = plistlib.loads(results.get("stdout").encode())
+	# 		model = plist_contents[0].get("product-name").decode().rstrip("\x00")
+
+	# elif sn_length == 12:
+	# 	model = lookup_model(serial_number[-4:])
+
+	# elif sn_length == 11:
+	# 	model = lookup_model(serial_number[-3:])
+
+	return {
+		# "serial_number": serial_number,
+		"uuid": get_hardware_uuid(),
+		# "board_id": get_board_id(),
+		# "model_id": get_model_id(),
+		# "model_friendly": model
+	}
+
+
+class ArchiveSession():
+	"""Keeps a single compressed archive open for an entire collection run.
+
+	Every item is written through the same `zipfile.ZipFile` handle, so the archive's
+	central directory is only read and written once, when the session is closed.  With
+	a `max_size`, entries that do not fit are cut down or skipped, so items should be
+	added in order of priority.
+
+	Args:
+		archive (str): Path to the archive file; will be created if it does not exist
+		mode (str, optional): The mode that will be used to open the archive. Defaults to "w".
+		compression (int, optional): The compression method for new entries.
+			Defaults to zipfile.ZIP_DEFLATED.
+		workers (int, optional): Number of files to compress at once.  Defaults to 1.
+		max_size (int, optional): Size in bytes the archive must not exceed.
+			Defaults to None.
+		manifest (IncrementalManifest, optional): Only archive what has changed since
+			the uploads recorded in the manifest, and record what is archived.
+			Defaults to None.
+		text_compression (int, optional): The compression method for large text files.
+			Defaults to None, i.e. `compression`.
+		volumes (int, optional): Most archive volumes to split the archive into when
+			it would exceed `max_size`.  Defaults to 1.
+		on_volume (callable, optional): Called with the path of each finished volume.
+			Defaults to None.
+	"""
+
+	spool_size = 8388608
+	truncatable = (".log", ".txt")
+	min_tail_size = 4096
+	sample_size = 8192
+	# Bits per byte above which data is considered already compressed or encrypted
+	entropy_threshold = 7.5
+	large_text_size = 1048576
+	# How far over the space left a file's estimated size must be before it is cut down
+	# without being compressed in full first
+	estimate_margin = 1.25
+	method_names = {
+		zipfile.ZIP_STORED: "stored",
+		zipfile.ZIP_DEFLATED: "deflated",
+		zipfile.ZIP_BZIP2: "bzip2"
+	}
+
+	def __init__(self, archive, mode="w", compression=zipfile.ZIP_DEFLATED, workers=1,
+		max_size=None, manifest=None, text_compression=None, volumes=1, on_volume=None):
+
+		self.mode = mode
+		self.max_volumes = volumes if max_size and isinstance(archive, str) else 1
+		self.on_volume = on_volume
+
+		if self.max_volumes > 1:
+			self.archive_template = "{}_part{{}}{}".format(*os.path.splitext(archive))
+			archive = self.archive_template.format(1)
+
+		self.archive = archive
+		self.volumes = [archive]
+		self.volume_entries = 0
+		# Finished volumes waiting on a changed file to be archived
+		self.held_volumes = []
+		self.compression = compression
+		self.text_compression = text_compression
+		self.started = time.monotonic()
+		# Entries, bytes read and bytes written by compression method
+		self.stats = {}
+		self.max_size = max_size
+		self.manifest = manifest
+		self.entries = 0
+		self.truncated = 0
+		# Files recorded in the manifest; command output and tables are never tracked
+		self.recorded = 0
+		self.skipped = 0
+		self.zip_file = zipfile.ZipFile(archive, mode, compression)
+		# Bytes the central directory and end of archive records will need
+		self.directory_size = 98
+		self.pending = deque()
+		self.window = workers * 2
+		self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+		self.spooled = bool(self.executor or max_size or manifest)
+		self.commands = []
+		self.command_executor = None
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+	def add_command(self, arcname, command, timeout=60, max_bytes=None, partial=False):
+		"""Run a command in the background and archive its output once it exits.
+
+		The output is compressed as it is produced, on its own thread, and appended to
+		the archive at the next opportunity once the command has finished.  Output of a
+		command that fails is discarded, as is the output of a command that runs past its
+		timeout, unless `partial` is set.  A command that produces more than `max_bytes`
+		of output is stopped and the output up to that point is archived.
+
+		Args:
+			arcname (str): Name to store the output under
+			command (str): The command line to run
+			timeout (int, optional): Seconds to let the command run.  Defaults to 60.
+			max_bytes (int, optional): Most bytes of output to archive.  Defaults to None.
+			partial (bool, optional): Archive the output a command produced before its
+				timeout.  Defaults to False.
+		"""
+
+		log.info(f"Collecting:  {command}")
+		zip_info = zipfile.ZipInfo(arcname, datetime.datetime.now().timetuple()[:6])
+		zip_info.compress_type = self.compression
+		zip_info.external_attr = 0o600 << 16
+
+		if not self.command_executor:
+			self.command_executor = ThreadPoolExecutor(thread_name_prefix="collector")
+
+		self.commands.append((command,
+			self.command_executor.submit(
+				self._run_command, command, zip_info, timeout, max_bytes, partial)))
+
+
+	def _run_command(self, command, zip_info, timeout, max_bytes=None, partial=False):
+		"""Compress a command's output into a temporary spool; runs on its own thread.
+
+		Args:
+			command (str): The command line to run
+			zip_info (zipfile.ZipInfo): The entry's metadata
+			timeout (int): Seconds to let the command run
+			max_bytes (int, optional): Most bytes of output to keep.  Defaults to None.
+			partial (bool, optional): Keep the output produced before the timeout.
+				Defaults to False.
+		Returns:
+			tuple | None:  Same as `_compress()`, or None if the command failed
+		"""
+
+		try:
+			process = subprocess.Popen(shlex.split(command), start_new_session=True,
+				stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+		except OSError as error:
+			log.warning(f"Unable to run command:  {command}  ({error})")
+			return None
+
+		timed_out = threading.Event()
+
+		def kill():
+			# Stop anything the command started as well, which could hold its output open
+			with suppress(ProcessLookupError):
+				os.killpg(process.pid, signal.SIGKILL)
+
+		def stop():
+			timed_out.set()
+			kill()
+
+		timer = threading.Timer(timeout, stop)
+		timer.start()
+
+		try:
+			with process.stdout:
+				compressed = self._compress(process.stdout, zip_info, limit=max_bytes)
+
+				if capped := max_bytes is not None and zip_info.file_size >= max_bytes:
+					kill()
+
+		finally:
+			timer.cancel()
+			process.wait()
+
+		if capped:
+			log.warning(f"Stopped after {max_bytes} bytes of output:  {command}")
+			zip_info.comment = f"Output cut off at {max_bytes} bytes".encode()
+
+		elif timed_out.is_set() and partial and zip_info.file_size:
+			log.warning(f"Command timed out, keeping its output so far:  {command}")
+			zip_info.comment = f"Output cut off after {timeout} seconds".encode()
+
+		elif timed_out.is_set() or process.returncode != 0:
+			compressed[1].close()
+			log.warning(f"Command {'timed out' if timed_out.is_set() else 'failed'}:  {command}")
+			return None
+
+		return compressed
+
+
+	def _commit_commands(self, wait=False):
+		"""Append the output of the commands that have finished.
+
+		Args:
+			wait (bool, optional): Wait for every command to finish.  Defaults to False.
+		"""
+
+		running = []
+
+		for command, future in self.commands:
+
+			if not (wait or future.done()):
+				running.append((command, future))
+
+			elif compressed := future.result():
+				self._commit(compressed)
+
+		self.commands = running
+
+
+	def add_path(self, path, arcname=None, since=None, **scan_options):
+		"""Add a file or directory to the archive.
+
+		Files are stored under their absolute path (without the leading slash) and
+		directories are stored relative to their parent directory.
+
+		Args:
+			path (str): Path to a file or directory to include in the archive
+			arcname (str, optional): Name to store a file under.  Defaults to None.
+			since (datetime, optional): Only include the lines of logs written at or
+				after this time.  Defaults to None.
+			**scan_options: Which files within a directory to include; see
+				`scan_directory()`
+		"""
+
+		path = os.path.abspath(path)
+		log.info(f"Archiving:  {path}")
+		self._commit_commands()
+
+		if os.path.isdir(path):
+			self.add_directory(path, since, **scan_options)
+
+		elif os.path.exists(path):
+			self.add_file(path, arcname, since)
+
+		else:
+			log.warning("Unable to locate the specified file!")
+
+
+	def add_file(self, path, arcname=None, since=None, stat_result=None):
+		"""Add a single file to the archive.
+
+		With more than one worker, the file is compressed into a temporary spool on a
+		worker thread (zlib and bz2 release the GIL while compressing) and appended in
+		the order it was added, so the archive is identical to one built on a single core.
+
+		Args:
+			path (str): Path to the file
+			arcname (str, optional): Name to store the file under.  Defaults to None.
+			since (datetime, optional): If the file is a log, only include the lines
+				written at or after this time.  Defaults to None.
+			stat_result (os.stat_result, optional): The file's status, if it has already
+				been looked up.  Defaults to None.
+		"""
+
+		stat_result = stat_result or os.stat(path)
+		offset = log_window_offset(path, since) if since and path.endswith(".log") else 0
+
+		if self.manifest:
+
+			if (uploaded := self.manifest.offset(path, stat_result)) is None:
+				log.info(f"Unchanged since the last upload:  {path}")
+				return
+
+			offset = max(offset, uploaded)
+
+		zip_info = self._zip_info(path, arcname, stat_result)
+		zip_info.compress_type, sample = self._compress_type(path, stat_result.st_size)
+
+		if not self.spooled and not offset:
+
+			with open(path, "rb") as source, self.zip_file.open(zip_info, "w") as entry:
+
+				while chunk := source.read(1048576):
+					entry.write(chunk)
+
+			self._account(zip_info)
+			return
+
+		if offset and since:
+			zip_info.comment = f"Lines logged since {since:%Y-%m-%d %H:%M:%S}".encode()
+
+		elif offset:
+			zip_info.comment = f"Lines added after byte {offset}".encode()
+
+		remaining = self._remaining(zip_info)
+
+		# Nothing can fit once the budget is used up, so skip compressing the file at all
+		if (remaining is not None and remaining <= 0 and not self.pending
+			and len(self.volumes) >= self.max_volumes):
+			log.warning(f"Skipping, the archive is out of space:  {zip_info.filename}")
+			self.skipped += 1
+			return
+
+		# Only a file that could come near the space left is worth estimating
+		if remaining is not None and stat_result.st_size - offset > remaining / 2:
+			ratio = self._sample_ratio(path, zip_info.compress_type, offset, sample)
+
+		else:
+			ratio = 1.0
+
+		oversized = (remaining is not None
+			and (stat_result.st_size - offset) * ratio > remaining * self.estimate_margin)
+
+		# A file that clearly will not fit is placed on its own, once the budget is exact
+		if not self.executor or oversized:
+			self._drain()
+			self._place(path, zip_info, offset, ratio)
+			return
+
+		self.pending.append(self.executor.submit(self._compress, path, zip_info, offset))
+
+		while len(self.pending) >= self.window:
+			self._commit(self.pending.popleft().result())
+
+
+	@staticmethod
+	def _zip_info(path, arcname, stat_result):
+		"""Describe a file as an archive entry from its status.
+
+		Args:
+			path (str): Path to the file
+			arcname (str | None): Name to store the file under, or None for its path
+			stat_result (os.stat_result): The file's status
+		Returns:
+			zipfile.ZipInfo:  The entry's metadata
+		"""
+
+		arcname = os.path.normpath(arcname or path).lstrip(os.sep)
+		zip_info = zipfile.ZipInfo(arcname, time.localtime(stat_result.st_mtime)[:6])
+		zip_info.external_attr = (stat_result.st_mode & 0xFFFF) << 16
+		zip_info.file_size = stat_result.st_size
+		return zip_info
+
+
+	def _compress_type(self, path, size):
+		"""Choose how to compress a file from its type, or a sample of its contents.
+
+		Already compressed files and high entropy data are stored as-is, and large text
+		files are compressed with the higher ratio `text_compression` method, if there is
+		one.  Only files whose type does not already decide the method are sampled.
+
+		Args:
+			path (str): Path to the file
+			size (int): Size of the file in bytes
+		Returns:
+			tuple:  The compression method, and the sample of the file that was read,
+				if one was
+		"""
+
+		if self.compression == zipfile.ZIP_STORED:
+			return self.compression, None
+
+		extension = os.path.splitext(path)[1].lower()
+		mimetype = mimetypes.guess_type(path)[0] or ""
+
+		if (extension in INCOMPRESSIBLE_EXTENSIONS
+			or mimetype.split("/")[0] in { "audio", "image", "video" }):
+			return zipfile.ZIP_STORED, None
+
+		if extension in TEXT_EXTENSIONS or mimetype.startswith("text/"):
+
+			if self.text_compression and size >= self.large_text_size:
+				return self.text_compression, None
+
+			return self.compression, None
+
+		if size < self.min_tail_size:
+			return self.compression, None
+
+		with open(path, "rb") as file_object:
+			sample = file_object.read(self.sample_size)
+
+		if byte_entropy(sample) > self.entropy_threshold:
+			return zipfile.ZIP_STORED, sample
+
+		if self.text_compression and size >= self.large_text_size and b"\0" not in sample:
+			return self.text_compression, sample
+
+		return self.compression, sample
+
+
+	def _sample_ratio(self, path, compress_type, offset=0, sample=None):
+		"""Estimate how much a file will compress from a sample of it.
+
+		Args:
+			path (str): Path to the file
+			compress_type (int): The compression method
+			offset (int, optional): Byte offset the entry starts from.  Defaults to 0.
+			sample (bytes, optional): A sample of the file that has already been read;
+				otherwise one is read from `offset`.  Defaults to None.
+		Returns:
+			float:  Estimated compressed bytes per byte of the file
+		"""
+
+		if compress_type == zipfile.ZIP_STORED:
+			return 1.0
+
+		if sample is None:
+
+			with open(path, "rb") as file_object:
+				file_object.seek(offset)
+				sample = file_object.read(self.sample_size)
+
+		if not sample:
+			return 1.0
+
+		if compress_type == zipfile.ZIP_BZIP2:
+			return len(bz2.compress(sample)) / len(sample)
+
+		compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+		return len(compressor.compress(sample) + compressor.flush()) / len(sample)
+
+
+	def _account(self, zip_info):
+		"""Count an entry that has been appended to the archive."""
+
+		stats = self.stats.setdefault(zip_info.compress_type, [0, 0, 0])
+		stats[0] += 1
+		stats[1] += zip_info.file_size
+		stats[2] += zip_info.compress_size
+		self.entries += 1
+		self.volume_entries += 1
+
+
+	def _spool(self):
+		"""A temporary spool for compressed data.
+
+		Spools that outgrow memory are written next to the archive; when the archive is
+		being streamed, they go straight to an anonymous temporary file, which is removed
+		as soon as it is created, so that only a chunk of an entry is ever in memory.
+		"""
+
+		if isinstance(self.archive, str):
+			return tempfile.SpooledTemporaryFile(
+				max_size=self.spool_size, dir=os.path.dirname(self.archive) or None)
+
+		return tempfile.TemporaryFile()
+
+
+	def _compress(self, source, zip_info, offset=0, limit=None, budget=None, target=None):
+		"""Compress a file or stream into a temporary spool; may run on a worker thread.
+
+		Args:
+			source (str | file-like): Path to a file, or an object with a `read()` method
+			zip_info (zipfile.ZipInfo): The entry's metadata; sizes and CRC are filled in
+			offset (int, optional): Start at the first line beginning at or after this
+				byte offset of the file.  Defaults to 0.
+			limit (int, optional): Stop after reading this many bytes.  Defaults to None.
+			budget (int, optional): Give up once the compressed data is larger than this
+				many bytes; the sizes then only cover what was read.  Defaults to None.
+			target (file-like, optional): Write the compressed data here instead of a
+				spool.  Defaults to None.
+		Returns:
+			tuple:  The completed ZipInfo, the spool holding the compressed data (None
+				with a `target`), the source, and for files, the offset just past the
+				last full line read
+		"""
+
+		if zip_info.compress_type == zipfile.ZIP_DEFLATED:
+			compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+		elif zip_info.compress_type == zipfile.ZIP_BZIP2:
+			compressor = bz2.BZ2Compressor()
+
+		else:
+			compressor = None
+
+		spool = target or self._spool()
+		data_start = spool.tell()
+		crc = size = lines_size = 0
+		start = end = None
+
+		with open(source, "rb") if isinstance(source, str) else nullcontext(source) as stream:
+
+			if offset:
+				stream.seek(offset - 1)
+				stream.readline()
+
+			if isinstance(source, str):
+				start = stream.tell()
+
+			# Collected logs are only recorded up to their last complete line, so leave a
+			# partial line for the next run once it is complete
+			if (self.manifest and isinstance(source, str) and source.endswith(".log")
+				and (lines_end := last_line_end(source, start)) is not None):
+				limit = lines_end - start if limit is None else min(limit, lines_end - start)
+
+			while chunk := stream.read(1048576 if limit is None else min(limit - size, 1048576)):
+				crc = zlib.crc32(chunk, crc)
+
+				if (newline := chunk.rfind(b"\n")) != -1:
+					lines_size = size + newline + 1
+
+				size += len(chunk)
+				spool.write(compressor.compress(chunk) if compressor else chunk)
+
+				if budget is not None and spool.tell() - data_start > budget:
+					compressor = None
+					break
+
+		if start is not None:
+			end = start + lines_size
+
+		if compressor:
+			spool.write(compressor.flush())
+
+		zip_info.CRC = crc
+		zip_info.file_size = size
+		zip_info.compress_size = spool.tell() - data_start
+
+		if target:
+			return zip_info, None, source, end
+
+		spool.seek(0)
+		return zip_info, spool, source, end
+
+
+	def _compress_entry(self, path, zip_info, offset, budget):
+		"""Compress a file for the archive, straight into it when possible.
+
+		When the archive is a file, the compressed data is written into it after a
+		placeholder header, so that it is only written once; otherwise it is compressed
+		into a spool.  Either way, compression stops early once the data is larger than
+		the budget.
+
+		Args:
+			path (str): Path to the file
+			zip_info (zipfile.ZipInfo): The entry's metadata
+			offset (int): Start at the first line beginning at or after this byte offset
+			budget (int | None): Bytes the compressed data may use
+		Returns:
+			tuple:  Same as `_compress()`
+		"""
+
+		# Headers written in place must not change size once the real sizes are known
+		if not isinstance(self.archive, str) or zip_info.file_size * 1.05 > zipfile.ZIP64_LIMIT:
+			return self._compress(path, zip_info, offset, budget=budget)
+
+		zip_info.header_offset = self.zip_file.fp.tell()
+		zip_info.CRC = zip_info.compress_size = 0
+		self.zip_file.fp.write(zip_info.FileHeader(False))
+		return self._compress(path, zip_info, offset, budget=budget, target=self.zip_file.fp)
+
+
+	def _discard(self, compressed):
+		"""Throw away an entry that was compressed but will not be appended."""
+
+		zip_info, spool, _, _ = compressed
+
+		if spool:
+			spool.close()
+
+		else:
+			self.zip_file.fp.seek(zip_info.header_offset)
+			self.zip_file.fp.truncate()
+
+
+	def _place(self, path, zip_info, offset, ratio):
+		"""Append a file to the archive, one entry at a time, fitting it into the budget.
+
+		The file is compressed straight into the archive when it is a file, and rolled
+		back if it does not fit.  A log estimated to be well over the space left is cut
+		down to its newest lines without compressing it in full first.
+
+		Args:
+			path (str): Path to the file
+			zip_info (zipfile.ZipInfo): The entry's metadata
+			offset (int): Start at the first line beginning at or after this byte offset
+			ratio (float): Estimated compressed bytes per byte of the file
+		"""
+
+		size = zip_info.file_size
+		estimate = (size - offset) * ratio
+		remaining = self._remaining(zip_info)
+
+		if (remaining is not None and estimate > remaining * self.estimate_margin
+			and self._next_volume(zip_info, estimate)):
+			remaining = self._remaining(zip_info)
+
+		if remaining is None or estimate <= remaining * self.estimate_margin:
+			compressed = self._compress_entry(path, zip_info, offset, remaining)
+
+			if remaining is None or zip_info.compress_size <= remaining:
+				self._append(compressed)
+				return
+
+			# Compression may have stopped early; estimate from what was compressed
+			self._discard(compressed)
+			ratio = zip_info.compress_size / max(zip_info.file_size, 1)
+			zip_info.file_size = size
+
+			if self._next_volume(zip_info, (size - offset) * ratio):
+				self._place(path, zip_info, offset, ratio)
+				return
+
+			remaining = self._remaining(zip_info)
+
+		self._fit(zip_info, path, offset, remaining, ratio)
+
+
+	def _remaining(self, zip_info):
+		"""Bytes left in the size budget for an entry's data.
+
+		Args:
+			zip_info (zipfile.ZipInfo): The entry that would be appended
+		Returns:
+			int:  Bytes available, or None when the archive's size is not limited
+		"""
+
+		if not self.max_size:
+			return None
+
+		return (self.max_size - self.zip_file.fp.tell() - self.directory_size
+			- self._overhead(zip_info))
+
+
+	@staticmethod
+	def _overhead(zip_info):
+		"""Bytes an entry needs for its local header and central directory record."""
+
+		return 124 + 2 * len(zip_info.filename.encode()) + len(zip_info.comment)
+
+
+	def _truncate(self, zip_info, source, offset, remaining, ratio):
+		"""Compress only the newest lines of a log so that it fits in the budget.
+
+		Args:
+			zip_info (zipfile.ZipInfo): The entry that did not fit
+			source (str | file-like): The entry's source
+			offset (int): Byte offset of the file the entry started from
+			remaining (int): Bytes left in the size budget
+			ratio (float): Estimated compressed bytes per byte of the log
+		Returns:
+			tuple | None:  Same as `_compress()`, or None if the log cannot be truncated
+		"""
+
+		if not (isinstance(source, str) and source.endswith(self.truncatable)):
+			return None
+
+		original_size = os.path.getsize(source) - offset
+		tail_size = int(remaining / max(ratio, 0.001) * 0.95)
+
+		while tail_size >= self.min_tail_size:
+			tail_info = zipfile.ZipInfo(zip_info.filename, zip_info.date_time)
+			tail_info.compress_type = zip_info.compress_type
+			tail_info.external_attr = zip_info.external_attr
+			tail_info.file_size = min(tail_size, original_size)
+			tail_info.comment = (
+				f"Truncated to the newest {tail_size} of {original_size} bytes".encode())
+			fits = self._remaining(tail_info)
+			tail = self._compress_entry(
+				source, tail_info, offset + max(original_size - tail_size, 0), fits)
+
+			if tail_info.compress_size <= fits:
+				return tail
+
+			self._discard(tail)
+			ratio = tail_info.compress_size / max(tail_info.file_size, 1)
+			tail_size = min(int(fits / max(ratio, 0.001) * 0.9), int(tail_size * 0.9))
+
+		return None
+
+
+	def _fit(self, zip_info, source, offset, remaining, ratio):
+		"""Append the newest lines of a log that does not fit, or skip the entry.
+
+		Args:
+			zip_info (zipfile.ZipInfo): The entry that did not fit
+			source (str | file-like): The entry's source
+			offset (int): Byte offset of the file the entry started from
+			remaining (int): Bytes left in the size budget
+			ratio (float): Estimated compressed bytes per byte of the entry
+		"""
+
+		if not (compressed := self._truncate(zip_info, source, offset, remaining, ratio)):
+			log.warning(f"Skipping, the archive is out of space:  {zip_info.filename}")
+			self.skipped += 1
+			return
+
+		log.warning(f"Truncated to fit the archive:  {compressed[0].filename}")
+		self.truncated += 1
+		self._append(compressed)
+
+
+	def _commit(self, compressed):
+		"""Append an entry that has already been compressed into a spool to the archive.
+
+		Args:
+			compressed (tuple):  The ZipInfo, spool, source and end returned by `_compress()`
+		"""
+
+		zip_info, spool, source, end = compressed
+		remaining = self._remaining(zip_info)
+
+		if (remaining is not None and zip_info.compress_size > remaining
+			and self._next_volume(zip_info, zip_info.compress_size)):
+			remaining = self._remaining(zip_info)
+
+		if remaining is not None and zip_info.compress_size > remaining:
+			spool.close()
+			# The entry was compressed in full, from the file's end back to where it started
+			offset = (max(os.path.getsize(source) - zip_info.file_size, 0)
+				if isinstance(source, str) else 0)
+			self._fit(zip_info, source, offset, remaining,
+				zip_info.compress_size / max(zip_info.file_size, 1))
+			return
+
+		self._append(compressed)
+
+
+	def _append(self, compressed):
+		"""Write an entry that fits into the archive and record it.
+
+		Args:
+			compressed (tuple):  The ZipInfo, spool, source and end returned by `_compress()`
+		"""
+
+		zip_info, spool, source, end = compressed
+
+		if spool:
+
+			with spool:
+				zip_info.header_offset = self.zip_file.fp.tell()
+				self.zip_file.fp.write(zip_info.FileHeader())
+
+				while chunk := spool.read(1048576):
+					self.zip_file.fp.write(chunk)
+
+		else:
+			# The data was compressed into the archive; fill in the placeholder header
+			end_of_data = self.zip_file.fp.tell()
+			self.zip_file.fp.seek(zip_info.header_offset)
+			self.zip_file.fp.write(zip_info.FileHeader(False))
+			self.zip_file.fp.seek(end_of_data)
+
+		self.zip_file.start_dir = self.zip_file.fp.tell()
+		self.zip_file.filelist.append(zip_info)
+		self.zip_file.NameToInfo[zip_info.filename] = zip_info
+		self.directory_size += 46 + len(zip_info.filename.encode()) + len(zip_info.comment) + 28
+		self._account(zip_info)
+
+		if self.manifest and end is not None:
+			self.manifest.record(source, end)
+			self.recorded += 1
+
+
+	def _next_volume(self, zip_info, compress_size):
+		"""Finish the current archive volume and start the next one.
+
+		Each volume is a complete archive named with a `_part<number>` suffix.  An entry
+		that does not fit in the current volume starts the next one, until the volumes
+		run out.
+
+		Args:
+			zip_info (zipfile.ZipInfo): The entry that does not fit in the current volume
+			compress_size (int): The entry's compressed size, or an estimate of it
+		Returns:
+			bool:  Whether a new volume was started
+		"""
+
+		# An entry too large for even an empty volume would only waste one
+		if (len(self.volumes) >= self.max_volumes or not self.volume_entries
+			or compress_size > self.max_size - 98 - self._overhead(zip_info)):
+			return False
+
+		self._finish_volume()
+		self.archive = self.archive_template.format(len(self.volumes) + 1)
+		self.volumes.append(self.archive)
+		self.volume_entries = 0
+		self.directory_size = 98
+		self.zip_file = zipfile.ZipFile(self.archive, self.mode, self.compression)
+		log.info(f"Starting archive volume:  {self.archive}")
+		return True
+
+
+	def _finish_volume(self):
+		"""Close the current archive volume and hand it off.
+
+		With a manifest, volumes are held back until a file that has changed since the
+		last upload has been archived, so that a run where nothing has changed hands
+		off nothing.
+		"""
+
+		self.zip_file.close()
+
+		if not (self.on_volume and self.volume_entries):
+			return
+
+		self.held_volumes.append(self.archive)
+
+		if self.manifest and not self.recorded:
+			return
+
+		for volume in self.held_volumes:
+			self.on_volume(volume)
+
+		self.held_volumes = []
+
+
+	def _drain(self):
+		"""Append every entry still being compressed, in order."""
+
+		while self.pending:
+			self._commit(self.pending.popleft().result())
+
+
+	def add_directory(self, path, since=None, **scan_options):
+		"""Add the files within a directory to the archive.
+
+		Args:
+			path (str): Path to the directory
+			since (datetime, optional): Only include the lines of logs written at or
+				after this time.  Defaults to None.
+			**scan_options: Which files to include; see `scan_directory()`
+		"""
+
+		for file_path, arcname, stat_result in scan_directory(path, **scan_options):
+			self.add_file(file_path, arcname, since, stat_result)
+
+
+	def add_bytes(self, arcname, data):
+		"""Add an in-memory blob to the archive.
+
+		Args:
+			arcname (str): Name to store the data under
+			data (bytes | str): Contents of the entry
+		"""
+
+		if isinstance(data, str):
+			data = data.encode()
+
+		self.add_stream(arcname, io.BytesIO(data))
+
+
+	def add_stream(self, arcname, stream, chunk_size=1048576):
+		"""Add the contents of a file-like object to the archive without buffering it.
+
+		Args:
+			arcname (str): Name to store the data under
+			stream (file-like): An object with a `read()` method returning bytes
+			chunk_size (int, optional): Bytes to read at a time.  Defaults to 1MB.
+		"""
+
+		log.info(f"Archiving:  {arcname}")
+		zip_info = zipfile.ZipInfo(arcname, datetime.datetime.now().timetuple()[:6])
+		zip_info.compress_type = self.compression
+		zip_info.external_attr = 0o600 << 16
+		self._drain()
+
+		if self.spooled:
+			self._commit(self._compress(stream, zip_info))
+			return
+
+		with self.zip_file.open(zip_info, "w", force_zip64=True) as entry:
+
+			while chunk := stream.read(chunk_size):
+				entry.write(chunk)
+
+		self._account(zip_info)
+
+
+	def close(self):
+		"""Write the central directory and close the archive."""
+
+		if self.zip_file.fp:
+
+			try:
+				self._drain()
+				self._commit_commands(wait=True)
+
+			except BaseException:
+				# Do not hand off an incomplete volume
+				self.on_volume = None
+				raise
+
+			finally:
+				for executor in (self.executor, self.command_executor):
+					if executor:
+						executor.shutdown(cancel_futures=True)
+				self._finish_volume()
+
+			log.debug(f"Archived {self.entries} item(s) into:  {', '.join(map(str, self.volumes))}")
+			log.info(f"Built the archive in {time.monotonic() - self.started:.1f} seconds")
+
+			for compress_type, (entries, read, written) in sorted(self.stats.items()):
+				log.info(f"  {self.method_names.get(compress_type, compress_type)}:  "
+					f"{entries} item(s), {read} bytes to {written} bytes")
+
+			if self.truncated or self.skipped:
+				log.warning(f"To stay within {self.max_size} bytes, {self.truncated} item(s) "
+					f"were truncated and {self.skipped} item(s) were skipped")
+
+
+class IteratorStream(io.RawIOBase):
+	"""A read-only file-like object over an iterator of bytes.
+
+	Args:
+		iterator (iterable):  Yields the contents of the stream as bytes
+	"""
+
+	def __init__(self, iterator):
+
+		self.iterator = iter(iterator)
+		self.buffer = b""
+
+
+	def readable(self):
+		return True
+
+
+	def readinto(self, buffer):
+
+		while not self.buffer:
+
+			try:
+				self.buffer = next(self.iterator)
+
+			except StopIteration:
+				return 0
+
+		size = min(len(buffer), len(self.buffer))
+		buffer[:size] = self.buffer[:size]
+		self.buffer = self.buffer[size:]
+		return size
+
+
+class ArchivePipe():
+	"""Builds an archive on a background thread and exposes it as a readable stream.
+
+	This allows the archive to be uploaded while it is still being compressed, without
+	the archive ever being written to disk; entries that have to be checked against
+	`max_size` are spooled to anonymous temporary files first.  The archive is built
+	to fit within `max_size`; if it still grows beyond it, or building it fails,
+	`read()` raises so the upload is aborted instead of completing with a truncated
+	archive.
+
+	Args:
+		build (callable): Called with an ArchiveSession to add items to
+		max_size (int, optional): Largest number of bytes to stream.  Defaults to None.
+		**kwargs: Passed to ArchiveSession
+	"""
+
+	def __init__(self, build, max_size=None, **kwargs):
+
+		read_fd, write_fd = os.pipe()
+		self.reader = os.fdopen(read_fd, "rb")
+		self.writer = os.fdopen(write_fd, "wb")
+		self.max_size = max_size
+		self.size = 0
+		self.error = None
+		self.thread = threading.Thread(
+			target=self._produce, args=(build, kwargs), daemon=True)
+		self.thread.start()
+
+
+	def _produce(self, build, kwargs):
+
+		try:
+			with ArchiveSession(self.writer, max_size=self.max_size, **kwargs) as archive:
+				build(archive)
+
+		except Exception as error:
+			self.error = error
+
+		finally:
+
+			try:
+				self.writer.close()
+
+			except BrokenPipeError:
+				# The reader stopped early; there is nothing left to flush to
+				pass
+
+
+	def read(self, size=-1):
+
+		chunk = self.reader.read(size)
+		self.size += len(chunk)
+
+		if self.max_size and self.size > self.max_size:
+			self.close()
+			raise ValueError("Archive is larger than the allowed max size")
+
+		if not chunk:
+			self.thread.join()
+
+			if self.error:
+				raise self.error
+
+		return chunk
+
+
+	def close(self):
+		"""Stop reading the archive; the builder will stop at its next write."""
+
+		self.reader.close()
+		self.thread.join()
+
+
+class MultipartStream():
+	"""A multipart/form-data request body that reads a file in chunks.
+
+	Passed as `data` to `requests`, the body is streamed with constant memory instead
+	of being built in memory like `files=` does.  When the size of the file is known,
+	`len` is set and the body is sent with a Content-Length header; otherwise it is
+	sent with chunked transfer encoding.
+
+	Args:
+		stream (file-like): An object with a `read()` method returning bytes
+		filename (str): File name to send for the form field
+		content_type (str, optional): Content type of the file.
+			Defaults to application/octet-stream.
+		size (int, optional): Size of the file in bytes, if known.  Defaults to None.
+		field (str, optional): Name of the form field.  Defaults to "file".
+		chunk_size (int, optional): Bytes to send at a time.  Defaults to 1MB.
+	"""
+
+	def __init__(self, stream, filename, content_type=None, size=None, field="file",
+		chunk_size=1048576):
+
+		boundary = uuid.uuid4().hex
+		self.content_type = f"multipart/form-data; boundary={boundary}"
+		self.chunk_size = chunk_size
+
+		filename = filename.replace('"', "%22")
+		preamble = (
+			f"--{boundary}\r\n"
+			f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+			f"Content-Type: {content_type or 'application/octet-stream'}\r\n\r\n"
+		).encode()
+		epilogue = f"\r\n--{boundary}--\r\n".encode()
+		self.parts = deque([io.BytesIO(preamble), stream, io.BytesIO(epilogue)])
+
+		if size is not None:
+			self.len = len(preamble) + size + len(epilogue)
+
+
+	def read(self, size=-1):
+
+		if size is None or size < 0:
+			return b"".join(iter(self))
+
+		chunks = []
+
+		while size > 0 and self.parts:
+
+			if chunk := self.parts[0].read(size):
+				chunks.append(chunk)
+				size -= len(chunk)
+
+			else:
+				self.parts.popleft()
+
+		return b"".join(chunks)
+
+
+	def __iter__(self):
+
+		while chunk := self.read(self.chunk_size):
+			yield chunk
+
+
+class IncrementalManifest():
+	"""Tracks what has been uploaded from each collected file so later runs can skip it.
+
+	The manifest is a plist kept in a root-only directory.  For every file it records
+	the inode, size and modification time, how far into the file has been uploaded and
+	a hash of the bytes just before that offset.  A log that has only been appended to
+	since then is collected from that offset; a file that was replaced, rotated,
+	truncated or rewritten is collected in full.
+
+	Args:
+		path (str): Path to the manifest
+		server (str): The Jamf Pro Server uploads are sent to; a manifest recorded for
+			another server is ignored
+	"""
+
+	boundary_size = 4096
+
+	def __init__(self, path, server):
+
+		self.path = path
+		self.server = server
+		self.files = {}
+		self.updates = {}
+
+		if os.path.exists(path):
+
+			try:
+				with open(path, "rb") as manifest_file:
+					manifest = plistlib.load(manifest_file)
+
+				if manifest.get("server") == server:
+					self.files = manifest.get("files", {})
+
+			except Exception:
+				log.warning(f"Ignoring unreadable manifest:  {path}")
+
+
+	def _boundary_hash(self, path, offset):
+		"""Hash the bytes that end at offset, to tell if they have been rewritten."""
+
+		with open(path, "rb") as file_object:
+			file_object.seek(max(offset - self.boundary_size, 0))
+			return hashlib.sha256(file_object.read(min(offset, self.boundary_size))).hexdigest()
+
+
+	def offset(self, path, stat_result=None):
+		"""Where to start collecting a file from.
+
+		Args:
+			path (str): Path to the file
+			stat_result (os.stat_result, optional): The file's status, if it has already
+				been looked up.  Defaults to None.
+		Returns:
+			int | None:  Byte offset to collect from, or None if nothing has changed
+		"""
+
+		if not (entry := self.files.get(path)):
+			return 0
+
+		stat = stat_result or os.stat(path)
+
+		if stat.st_ino != entry["inode"] or stat.st_size < entry["offset"]:
+			return 0
+
+		if not path.endswith(".log") and (
+			stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]):
+			return 0
+
+		if self._boundary_hash(path, entry["offset"]) != entry["hash"]:
+			return 0
+
+		# Logs are only collected a line at a time, once the line is complete
+		if stat.st_size == entry["offset"] or (path.endswith(".log")
+			and last_line_end(path, entry["offset"], stat.st_size) is None):
+			return None
+
+		return entry["offset"]
+
+
+	def record(self, path, end):
+		"""Note how much of a file has been archived.
+
+		Args:
+			path (str): Path to the file
+			end (int): Offset just past the last full line that was archived
+		"""
+
+		stat = os.stat(path)
+		offset = end if path.endswith(".log") else stat.st_size
+		self.updates[path] = {
+			"inode": stat.st_ino,
+			"size": stat.st_size,
+			"mtime": stat.st_mtime,
+			"offset": offset,
+			"hash": self._boundary_hash(path, offset)
+		}
+
+
+	def save(self):
+		"""Write the manifest, once what was recorded has been uploaded."""
+
+		self.files |= self.updates
+		self.updates = {}
+		os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+
+		with open(f"{self.path}.tmp", "wb") as manifest_file:
+			plistlib.dump({ "server": self.server, "files": self.files }, manifest_file)
+
+		os.replace(f"{self.path}.tmp", self.path)
+
+
+def byte_entropy(data):
+	"""Calculate the Shannon entropy of data.
+
+	Compressed and encrypted data is close to 8 bits per byte; text is usually well
+	under 6.
+
+	Args:
+		data (bytes): The data to measure
+	Returns:
+		float:  Entropy in bits per byte, from 0 to 8
+	"""
+
+	if not data:
+		return 0.0
+
+	total = len(data)
+
+	return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def scan_directory(path, include=None, exclude=None, max_depth=None, max_file_size=None,
+	symlinks="files", max_files=None):
+	"""Find the files within a directory to collect.
+
+	Each directory is listed once with `os.scandir()`, whose entries already know their
+	type, and each file's status is looked up once and handed back for the archive to
+	reuse.  Sockets, pipes and devices are always skipped and excluded directories are
+	not descended into.
+
+	Patterns are shell-style wildcards matched against both the name of a file or
+	directory and its path relative to the directory's parent, e.g. "*.sock", "Caches"
+	or "Logs/*/Archive".
+
+	Args:
+		path (str): Path to the directory
+		include (list, optional): Only collect files matching one of these patterns.
+			Defaults to None, i.e. every file.
+		exclude (list, optional): Skip files and directories matching one of these
+			patterns.  Defaults to None.
+		max_depth (int, optional): Levels of subdirectories to descend into; 0 only
+			collects the directory's own files.  Defaults to None, i.e. no limit.
+		max_file_size (int, optional): Skip files larger than this many bytes.
+			Defaults to None.
+		symlinks (str, optional): "skip" symbolic links, follow links to "files" only,
+			or "follow" links to files and directories.  Defaults to "files".
+		max_files (int, optional): Stop after finding this many files.
+			Defaults to None.
+	Yields:
+		tuple:  The path of each file, its path relative to the directory's parent and
+			its `os.stat_result`
+	"""
+
+	def matches(patterns, name, relative_path):
+		return any(fnmatch.fnmatchcase(name, pattern)
+			or fnmatch.fnmatchcase(relative_path, pattern) for pattern in patterns)
+
+	root = path.rstrip(os.sep) or os.sep
+	# Directories still to list, with their path relative to the root's parent and depth
+	directories = [(root, os.path.basename(root), 0)]
+	# Directories already listed, so that followed links cannot loop
+	visited = set()
+	found = 0
+
+	while directories:
+		directory, relative_directory, depth = directories.pop()
+		subdirectories = []
+
+		try:
+			if symlinks == "follow":
+				directory_stat = os.stat(directory)
+
+				if (directory_stat.st_dev, directory_stat.st_ino) in visited:
+					continue
+
+				visited.add((directory_stat.st_dev, directory_stat.st_ino))
+
+			entries = os.scandir(directory)
+
+		except OSError as error:
+			log.warning(f"Unable to read the directory:  {error}")
+			continue
+
+		with entries:
+
+			for entry in entries:
+				relative_path = (
+					f"{relative_directory}/{entry.name}" if relative_directory else entry.name)
+
+				if exclude and matches(exclude, entry.name, relative_path):
+					log.debug(f"Excluded:  {entry.path}")
+					continue
+
+				try:
+					if entry.is_symlink():
+
+						if symlinks == "skip":
+							continue
+
+						entry_stat = entry.stat()
+
+						if stat.S_ISDIR(entry_stat.st_mode) and symlinks == "follow":
+							subdirectories.append((entry.path, relative_path))
+							continue
+
+					elif entry.is_dir(follow_symlinks=False):
+						subdirectories.append((entry.path, relative_path))
+						continue
+
+					else:
+						entry_stat = entry.stat(follow_symlinks=False)
+
+				except OSError as error:
+					log.debug(f"Skipping, unable to read:  {error}")
+					continue
+
+				# Sockets, pipes, devices and links to directories that are not followed
+				if not stat.S_ISREG(entry_stat.st_mode):
+					continue
+
+				if include and not matches(include, entry.name, relative_path):
+					continue
 
-	Args:
-		command (str):  The command line level syntax that would be written in a
-			shell script or a terminal window
+				if max_file_size is not None and entry_stat.st_size > max_file_size:
+					log.info(f"Skipping, larger than {max_file_size} bytes:  {entry.path}")
+					continue
 
-	Returns:
-		dict:  Results in a dictionary
-	"""
+				if max_files is not None and found >= max_files:
+					log.warning(f"Stopped after collecting {max_files} file(s) from:  {root}")
+					return
 
-	# Validate that command is not a string
-	if not isinstance(command, str):
-		raise TypeError("Command must be a str type")
-
-	# Format the command
-	command = shlex.split(command)
-
-	# Run the command
-	process = subprocess.Popen(
-		command,
-		stdin=subprocess.PIPE,
-		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE,
-		shell=False,
-		universal_newlines=True
-	)
+				found += 1
+				yield entry.path, relative_path, entry_stat
 
-	if input:
-		(stdout, stderr) = process.communicate(input=input)
+		if max_depth is None or depth < max_depth:
+			directories.extend(
+				(subdirectory, relative_path, depth + 1)
+				for subdirectory, relative_path in reversed(subdirectories)
+			)
 
-	else:
-		(stdout, stderr) = process.communicate()
 
-	return {
-		"stdout": (stdout).strip(),
-		"stderr": (stderr).strip() if stderr != None else None,
-		"exitcode": process.returncode,
-		"success": True if process.returncode == 0 else False
-	}
+# Timestamp formats at the start of the lines of the logs that are commonly collected
+LOG_TIMESTAMP_FORMATS = (
+	# install.log:  2023-12-04 10:11:12-08
+	(re.compile(rb"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})"), "%Y-%m-%d %H:%M:%S"),
+	# jamf.log:  Mon Dec  4 10:11:12
+	(re.compile(rb"\w{3} (\w{3} [ \d]\d \d{2}:\d{2}:\d{2})"), "%Y %b %d %H:%M:%S"),
+	# system.log:  Dec  4 10:11:12
+	(re.compile(rb"(\w{3} [ \d]\d \d{2}:\d{2}:\d{2})"), "%Y %b %d %H:%M:%S")
+)
 
 
-def db_table_writer(database, table):
-	"""A helper function read the contents of a database table and write to a csv.
+def log_timestamp(line):
+	"""Parse the timestamp at the start of a log line.
 
-	Borrowed and modified from:  https://stackoverflow.com/a/36211470
+	Formats without a year are assumed to be from the last twelve months, so in a log
+	that spans several years they go backwards at each year's rollover.
 
 	Args:
-		database:  A database that can be opened with sqlite
-		table:  A table in the database to select
+		line (bytes): A line from a log file
 	Returns:
-		file:  Returns the abspath of the file.
+		datetime | None:  The time the line was logged, or None if it has no timestamp
 	"""
 
-	file_name = f"/private/tmp/{table}.csv"
+	for pattern, time_format in LOG_TIMESTAMP_FORMATS:
 
-	# Setup database connection
-	db_connect = sqlite3.connect(database)
-	database = db_connect.cursor()
+		if match := pattern.match(line):
+			text = match.group(1).decode()
 
-	# Execute query
-	database.execute(f"select * from {table}")
+			try:
 
-	# Write to file
-	with open(file_name,"w") as table_csv:
-		csv_out = csv.writer(table_csv)
-		# Write header
-		csv_out.writerow([description[0] for description in database.description])
-		# Write data
-		for result in database:
-			csv_out.writerow(result)
+				if not time_format.startswith("%Y-"):
+					now = datetime.datetime.now()
+					timestamp = datetime.datetime.strptime(f"{now.year} {text}", time_format)
 
-	return os.path.abspath(file_name)
+					if timestamp > now + datetime.timedelta(days=1):
+						timestamp = timestamp.replace(year=now.year - 1)
 
+					return timestamp
 
-def get_system_info():
-	"""
-	A helper function to get specific system attributes.
+				return datetime.datetime.strptime(text, time_format)
 
-	Credit:  Mikey Mike/Froger/Pudquick/etc
-	Source:  https://gist.github.com/pudquick/c7dd1262bd81a32663f0
-	Notes:  Modified from source
+			except ValueError:
+				return None
 
-	Args:
-		attribute:  The system attribute desired.
+	return None
 
-	Returns:
-		stdout:  The system attribute value.
-	"""
 
-	IOKit_bundle = NSBundle.bundleWithIdentifier_("com.apple.framework.IOKit")
-	functions = [
-		("IORegistryEntryCreateCFProperty", b"@I@@I"),
-		("IOServiceGetMatchingService", b"II@"),
-		("IOServiceMatching", b"@*")
-	]
-	objc.loadBundleFunctions(IOKit_bundle, globals(), functions)
+def log_window_offset(path, since, max_lines=64):
+	"""Find where the lines logged at or after a point in time start in a log file.
 
-	def io_key(key_name, service_name="IOPlatformExpertDevice"):
-		service = IOServiceMatching(service_name.encode("utf-8"))
-		key = NSString.stringWithString_(key_name)
-		return IORegistryEntryCreateCFProperty(
-			IOServiceGetMatchingService(0, service), key, None, 0)
+	Binary searches the file by seeking, so only a few lines are ever read, and
+	assumes the lines are in chronological order.  Lines without a timestamp are
+	treated as part of the entry before them.
 
-	def get_hardware_uuid():
-		return io_key("IOPlatformUUID")
+	Timestamps without a year repeat every year, so the search is limited to the
+	newest lines:  the file is probed backwards from its end, in growing steps, until
+	a timestamp before the window or a year rollover (a timestamp later than the one
+	after it) is found.  Lines from before the last rollover are never in the window.
 
-	# def get_hardware_serial():
-	# 	return io_key("IOPlatformSerialNumber")
+	Args:
+		path (str): Path to the log file
+		since (datetime): The start of the time window
+		max_lines (int, optional): Lines to read looking for a timestamp before giving
+			up on a position.  Defaults to 64.
+	Returns:
+		int:  Byte offset of the first line in the window; 0 if the file's
+			timestamps are not recognized
+	"""
 
-	# def get_board_id():
-	# 	try:
-	# 		return bytes(io_key("board-id")).decode().rstrip("\x00")
-	# 	except TypeError:
-	# 		return ""
+	def next_timestamp(file_object, position):
+		"""Returns the start and timestamp of the first timestamped line at or after position"""
 
-	# def get_model_id():
-	# 	return bytes(io_key("model")).decode().rstrip("\x00")
+		file_object.seek(max(position - 1, 0))
 
-	# def lookup_model(lookup_code):
-	# 	xml = requests.get(f"https://support-sp.apple.com/sp/product?cc={lookup_code}").text
+		if position:
+			file_object.readline()
 
-	# 	try:
-	# 		tree = ElementTree.fromstringlist(xml)
-	# 		return tree.find(".//configCode").text
+		for _ in range(max_lines):
+			start = file_object.tell()
 
-	# 	except ElementTree.ParseError as err:
-	# 		log.info(f"Failed to retrieve model name:  {err.strerror}")
-	# 		return ""
+			if not (line := file_object.readline()):
+				break
 
+			if timestamp := log_timestamp(line):
+				return start, timestamp
 
-	# serial_number = get_hardware_serial()
-	# sn_length = len(serial_number)
-	# model = ""
+		return None, None
 
-	# if sn_length == 10:
-	# 	results = execute_process("/usr/sbin/ioreg -arc IOPlatformDevice -k product-name")
+	with open(path, "rb") as file_object:
 
-	# 	if results.get("success"):
-	# 		plist_contents = plistlib.loads(results.get("stdout").encode())
-	# 		model = plist_contents[0].get("product-name").decode().rstrip("\x00")
+		if next_timestamp(file_object, 0)[1] is None:
+			return 0
 
-	# elif sn_length == 12:
-	# 	model = lookup_model(serial_number[-4:])
+		size = os.fstat(file_object.fileno()).st_size
+		# The newest timestamp seen so far, and the position it was probed from
+		newest, high = None, size
+		step = 65536
 
-	# elif sn_length == 11:
-	# 	model = lookup_model(serial_number[-3:])
+		while high:
+			low = max(high - step, 0)
+			_, timestamp = next_timestamp(file_object, low)
 
-	return {
-		# "serial_number": serial_number,
-		"uuid": get_hardware_uuid(),
-		# "board_id": get_board_id(),
-		# "model_id": get_model_id(),
-		# "model_friendly": model
-	}
+			if timestamp is not None and (
+				timestamp < since or (newest is not None and timestamp > newest)):
+				break
 
+			newest = timestamp or newest
+			high = low
+			step *= 2
 
-def archiver(path, archive, mode="a"):
-	"""A Context Manager for creating or modifying a compressed archive.
+		while low < high:
+			middle = (low + high) // 2
+			_, timestamp = next_timestamp(file_object, middle)
 
-	Args:
-		path (str): Path to a file or directory to include in the archive
-		archive (str): Path to the archive file; will be created if it does not exist
-		mode (str, optional): The mode that will be used to open the archive. Defaults to "a".
-	"""
+			if timestamp is None or since <= timestamp <= (newest or timestamp):
+				high = middle
+			else:
+				low = middle + 1
 
-	log.info(f"Archiving:  {os.path.abspath(path)}")
+		start, _ = next_timestamp(file_object, low)
 
-	if os.path.exists(path):
+		return os.fstat(file_object.fileno()).st_size if start is None else start
 
-		with zipfile.ZipFile(archive, mode, zipfile.ZIP_DEFLATED) as zip_file:
 
-			if os.path.isdir(path):
+def last_line_end(path, start=0, end=None):
+	"""Find where the last complete line of a file ends.
 
-				for root, dirs, files in os.walk(path):
+	Args:
+		path (str): Path to the file
+		start (int, optional): Only look for the end of a line at or after this byte
+			offset.  Defaults to 0.
+		end (int, optional): Treat the file as ending at this byte offset.
+			Defaults to None, i.e. its size.
+	Returns:
+		int | None:  Byte offset just past the last newline, or None if there is no
+			newline between `start` and `end`
+	"""
 
-					for file in files:
+	with open(path, "rb") as file_object:
+		position = os.fstat(file_object.fileno()).st_size if end is None else end
 
-						zip_file.write(
-							os.path.join(root, file),
-							os.path.relpath(
-								os.path.join(root, file),
-								os.path.join(path, '..')
-							)
-						)
+		while position > start:
+			block_start = max(position - 65536, start)
+			file_object.seek(block_start)
 
-			else:
+			if (newline := file_object.read(position - block_start).rfind(b"\n")) != -1:
+				return block_start + newline + 1
 
-				zip_file.write(os.path.abspath(path), compress_type=zipfile.ZIP_DEFLATED)
+			position = block_start
 
-	else:
-		log.warning("Unable to locate the specified file!")
+	return None
 
 
-def write_to_file(file, data):
-	"""A simple helper function to write data to a file.
+def time_window(value):
+	"""An argparse type for durations such as 30m, 12h, 1d or 2w.
 
 	Args:
-		file (str): Path to where the file should be written
-		data (str): Contents that will be written to the file
+		value (str): The duration
+	Returns:
+		datetime:  The time that is the duration before now
 	"""
 
-	with open(file, "w") as file_object:
-		file_object.write(data)
+	units = { "m": "minutes", "h": "hours", "d": "days", "w": "weeks" }
+
+	if not (match := re.fullmatch(r"(\d+)([mhdw])", value.strip())):
+		raise argparse.ArgumentTypeError(
+			f"invalid duration: '{value}' (expected a number followed by m, h, d or w)")
+
+	return datetime.datetime.now() - datetime.timedelta(
+		**{ units[match.group(2)]: int(match.group(1)) })
 
 
 ##################################################
@@ -308,13 +1819,10 @@ def jamf_pro_url():
 	Helper function to return the Jamf Pro URL the device is enrolled with
 	"""
 
-	# Define Variables
-	jamf_plist = "/Library/Preferences/com.jamfsoftware.jamf.plist"
-
 	# Get the systems' Jamf Pro Server
-	if os.path.exists(jamf_plist):
+	if os.path.exists(JAMF_PLIST):
 
-		with open(jamf_plist, "rb") as jamf_plist_file:
+		with open(JAMF_PLIST, "rb") as jamf_plist_file:
 			jamf_plist_contents = plistlib.load(jamf_plist_file)
 
 		jps_url = jamf_plist_contents.get("jss_url")
@@ -326,17 +1834,207 @@ def jamf_pro_url():
 		sys.exit(1)
 
 
-JPS_URL = jamf_pro_url()
+class JamfProClient():
+	"""A client for the Jamf Pro API(s) that reuses its connections and API token.
+
+	Requests are sent through a single `requests.Session`, so connections to the Jamf Pro
+	Server are kept alive and reused.  The token's expiration is tracked and the token is
+	renewed shortly before it expires.  Optionally, the token can be cached on disk
+	(readable only by root) so that back-to-back runs skip authenticating.
+
+	Args:
+		url (str): The Jamf Pro Server's URL
+		username (str): Username for a Jamf Pro account
+		password (str): Password for a Jamf Pro account
+		token_cache (str, optional): Path to cache the token at.  Defaults to None.
+		refresh_margin (int, optional): Renew the token when it expires within this
+			many seconds.  Defaults to 60.
+	"""
+
+	def __init__(self, url, username, password, token_cache=None, refresh_margin=60):
+
+		import requests
+
+		self.url = url.rstrip("/")
+		self.username = username
+		self.password = password
+		self.token_cache = token_cache
+		self.refresh_margin = refresh_margin
+		self.token = None
+		self.expires = 0
+		self.session = requests.Session()
+		# Requests may be sent from several threads at once
+		self.lock = threading.Lock()
+
+		if token_cache:
+			self._load_token()
+
+
+	def _cache_key(self):
+		"""Identifies the server and account a cached token belongs to."""
+
+		return hashlib.sha256(f"{self.url}|{self.username}".encode()).hexdigest()
+
+
+	def _load_token(self):
+
+		try:
+			stat = os.stat(self.token_cache)
+
+			# Only trust a cache that no one else could have written or read
+			if stat.st_uid != os.geteuid() or stat.st_mode & 0o077:
+				log.warning(f"Ignoring token cache with unsafe permissions:  {self.token_cache}")
+				return
+
+			with open(self.token_cache, "r") as cache_file:
+				cache = json.load(cache_file)
+
+			if cache.get("key") == self._cache_key():
+				self.token = cache.get("token")
+				self.expires = cache.get("expires", 0)
+				log.debug("Using cached API token.")
+
+		except FileNotFoundError:
+			pass
+
+		except Exception:
+			log.warning(f"Ignoring unreadable token cache:  {self.token_cache}")
+
+
+	def _save_token(self):
+
+		try:
+			os.makedirs(os.path.dirname(self.token_cache), mode=0o700, exist_ok=True)
+			file_descriptor = os.open(
+				f"{self.token_cache}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+			with os.fdopen(file_descriptor, "w") as cache_file:
+				json.dump(
+					{ "key": self._cache_key(), "token": self.token, "expires": self.expires },
+					cache_file
+				)
+
+			os.replace(f"{self.token_cache}.tmp", self.token_cache)
+
+		except OSError as error:
+			log.warning(f"Unable to cache the API token:  {error}")
+
+
+	@staticmethod
+	def _parse_expires(expires):
+		"""Convert the API's expiration time (e.g. 2023-12-04T18:30:00.123Z) to epoch."""
+
+		return datetime.datetime.strptime(
+			expires.split(".")[0].rstrip("Z"), "%Y-%m-%dT%H:%M:%S"
+		).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+	def _set_token(self, response):
+
+		result = response.json()
+		self.token = result.get("token")
+		self.expires = self._parse_expires(result.get("expires"))
+		log.debug("Obtained an API token.")
+
+		if self.token_cache:
+			self._save_token()
+
+
+	def authenticate(self, force=False):
+
+		with self.lock:
+			return self._authenticate(force)
 
 
-def jamf_pro_api(api_account: dict, method: str, endpoint: str,
+	def _authenticate(self, force=False):
+		"""Make sure there is a token that will not expire soon.
+
+		A token that is still valid is renewed through the keep-alive endpoint; otherwise
+		a new token is requested with the account's credentials.
+
+		Args:
+			force (bool, optional): Discard the current token.  Defaults to False.
+		Returns:
+			bool:  Whether a usable token is available
+		"""
+
+		now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+
+		if force:
+			self.token = None
+
+		if self.token and self.expires - now > self.refresh_margin:
+			return True
+
+		try:
+
+			if self.token and self.expires > now:
+				response = self.session.post(
+					url = f"{self.url}/{PRO_API_ENDPOINTS.get('auth_keep_alive')}",
+					headers = { "Authorization": f"jamf-token {self.token}" }
+				)
+
+				if response.status_code == 200:
+					self._set_token(response)
+					return True
+
+			# Create a token based on user provided credentials
+			response = self.session.post(
+				url = f"{self.url}/{PRO_API_ENDPOINTS.get('auth_token')}",
+				auth = (self.username, self.password)
+			)
+
+			if response.status_code == 200:
+				self._set_token(response)
+				return True
+
+			log.error("Failed to authenticate with the Jamf Pro Server.")
+
+		except Exception:
+			log.error("Failed to connect to the Jamf Pro Server.")
+
+		self.token = None
+		return False
+
+
+	def request(self, method, endpoint, headers=None, **kwargs):
+		"""Send an authenticated request to the Jamf Pro Server.
+
+		If the server rejects the token (e.g. it was revoked), a new token is obtained
+		and the request is sent once more, unless its body is a stream that has already
+		been consumed.
+
+		Args:
+			method (str): HTTP Method that should be used
+			endpoint (str): The API's endpoint URL
+			headers (dict, optional): Headers to send.  Defaults to None.
+			**kwargs: Passed to `requests.Session.request()`
+		Returns:
+			requests.Response:  The response
+		"""
+
+		for attempt in range(2):
+			self.authenticate(force=bool(attempt))
+			response = self.session.request(
+				method,
+				f"{self.url}/{endpoint}",
+				headers = (headers or {}) | { "Authorization": f"jamf-token {self.token}" },
+				**kwargs
+			)
+
+			if response.status_code != 401 or hasattr(kwargs.get("data"), "read"):
+				break
+
+		return response
+
+
+def jamf_pro_api(client: JamfProClient, method: str, endpoint: str,
 	receive_content_type: str = "json", send_content_type = "xml",
 	data: Union[str, dict, None] = None, **kwargs):
 	"""Helper function to interact with the Jamf Pro API(s).
 
 	Args:
-		api_account (dict): Dict contain the username and password to use
-			when interacting with the Jamf Pro API.
+		client (JamfProClient): The client to send requests through.
 		method (str): HTTP Method that should be used.
 		endpoint (str): The API's endpoint URL
 		receive_content_type (str, optional): The content type to request the API to
@@ -345,21 +2043,16 @@ def jamf_pro_api(api_account: dict, method: str, endpoint: str,
 			Defaults to "xml".
 		data (str | dict | None, optional): A data payload that will be sent to the API.
 			Defaults to None.
+		file (str, optional): Path of a file to upload as multipart/form-data.
+		stream (file-like, optional): Read the uploaded file from this stream instead
+			of from `file`, which is then only used as the file name.
 
 	Returns:
 		requests.response: A request.response object
 	"""
 
-	if not api_account.get("api_token"):
-		api_account |= get_token(
-			api_account.get("username"),
-			api_account.get("password")
-		)
-
-	# Setup API URL and Headers
-	url = f"{JPS_URL}{endpoint}"
+	# Setup API Headers
 	headers = {
-		"Authorization": f"jamf-token {api_account.get('api_token')}",
 		"Accept": f"application/{receive_content_type}",
 		"Content-Type": f"application/{send_content_type}"
 	}
@@ -371,84 +2064,161 @@ def jamf_pro_api(api_account: dict, method: str, endpoint: str,
 
 		if method == "get":
 
-			return requests.get(url=url, headers=headers)
+			return client.request("GET", endpoint, headers=headers)
 
 		elif method in { "post", "create" }:
 
 			if upload_file := kwargs.get("file"):
 
 				content_type = mimetypes.guess_type(upload_file)[0]
-				headers.pop("Content-Type")
-
-				file = {
-					"file": (
-						upload_file,
-						open(upload_file, "rb"),
-						content_type
-					)
-				}
-
-				return requests.post(
-					url = url,
-					headers = headers,
-					files = file
-				)
 
+				if stream := kwargs.get("stream"):
+					body = MultipartStream(stream, upload_file, content_type)
+					headers["Content-Type"] = body.content_type
 
-			return requests.post(
-				url = url,
-				headers = headers,
-				data = data
-			)
+					return client.request("POST", endpoint, headers=headers, data=body)
+
+				with open(upload_file, "rb") as file:
+					body = MultipartStream(
+						file, upload_file, content_type, size=os.path.getsize(upload_file))
+					headers["Content-Type"] = body.content_type
+
+					return client.request("POST", endpoint, headers=headers, data=body)
+
+			return client.request("POST", endpoint, headers=headers, data=data)
 
 		elif method in { "put", "update" }:
 
-			return requests.put(
-				url = url,
-				headers = headers,
-				data = data
-			)
+			return client.request("PUT", endpoint, headers=headers, data=data)
 
 		elif method == "delete":
 
-			return requests.delete(
-				url = url,
-				headers = headers
-			)
+			return client.request("DELETE", endpoint, headers=headers)
 
 	except Exception:
 
 		log.error("Failed to connect to the Jamf Pro Server.")
 
 
-def get_token(username: str, password: str):
-	"""A helper function use to obtain a Jamf Pro API Token.
+def upload_archive(client: JamfProClient, computer_id: int, archive: str,
+	stream = None, retries: int = 0):
+	"""Helper function to upload an archive as an attachment to a computer's record.
+
+	Uploads that fail to connect, are throttled or hit a server error are retried after
+	an increasing delay.  A streamed upload cannot be sent again, so is never retried.
 
 	Args:
-		username (str): Username for a Jamf Pro account
-		password (str): Password for a Jamf Pro account
+		client (JamfProClient): The client to send requests through.
+		computer_id (int): The computer's ID
+		archive (str): Path of the archive to upload
+		stream (file-like, optional): Read the archive from this stream instead.
+			Defaults to None.
+		retries (int, optional): Times to retry a failed upload.  Defaults to 0.
 
 	Returns:
-		dict: Results of the API Token request
+		requests.response | None: The response to the last attempt
+	"""
+
+	for attempt in range(retries + 1):
+
+		if attempt:
+			log.info(f"Retrying upload of:  {archive}  (attempt {attempt + 1})")
+			time.sleep(2 ** attempt)
+
+		response = jamf_pro_api(
+			client = client,
+			method = "post",
+			endpoint = f"{PRO_API_ENDPOINTS.get('computer_attachments')}".format(id=computer_id),
+			receive_content_type = "json",
+			file = archive,
+			stream = stream
+		)
+
+		if stream or (response is not None and response.status_code < 500
+			and response.status_code != 429):
+			break
+
+	return response
+
+
+def enrollment_marker():
+	"""
+	Helper function to identify the device's current Jamf Pro enrollment
+
+	The jamf binary rewrites its configuration file when the device is enrolled, so
+	the file's inode and modification time change with each enrollment.
 	"""
 
 	try:
+		stat = os.stat(JAMF_PLIST)
+		return f"{stat.st_ino}-{stat.st_mtime}"
+
+	except OSError:
+		return None
+
+
+def get_computer_id(client: JamfProClient, udid: str, cache: Union[str, None] = None,
+	refresh: bool = False):
+	"""Helper function to get the device's computer ID from Jamf Pro.
+
+	Only the General subset of the computer record is requested.  The ID is cached
+	along with the server and enrollment it belongs to, and is looked up again when
+	the device is re-enrolled or `refresh` is set.
+
+	Args:
+		client (JamfProClient): The client to send requests through.
+		udid (str): The device's hardware UUID
+		cache (str, optional): Path to cache the computer ID at.  Defaults to None.
+		refresh (bool, optional): Ignore the cached computer ID.  Defaults to False.
+
+	Returns:
+		int | None: The computer ID, or None if it could not be retrieved
+	"""
+
+	cache_key = { "server": client.url, "udid": udid, "enrollment": enrollment_marker() }
+
+	if cache and not refresh and os.path.exists(cache):
+
+		try:
+			with open(cache, "r") as cache_file:
+				cached = json.load(cache_file)
+
+			if all(cached.get(key) == value for key, value in cache_key.items()):
+				log.debug(f"Computer ID (cached):  {cached['id']}")
+				return cached["id"]
+
+		except Exception:
+			log.warning(f"Ignoring unreadable computer ID cache:  {cache}")
+
+	# Query the API to get the computer ID
+	response_computer_details = jamf_pro_api(
+		client = client,
+		method = "get",
+		endpoint = CLASSIC_API_ENDPOINTS.get("computers_by_udid_general").format(udid=udid)
+	)
 
-		# Create a token based on user provided credentials
-		response_get_token = requests.post(
-			url = f"{JPS_URL}/{PRO_API_ENDPOINTS.get('auth_token')}",
-			auth = (username, password)
+	if response_computer_details is None or int(response_computer_details.status_code) != 200:
+		log.error("Failed to retrieve devices' computer ID!\n"
+			f"API Status Code:  {getattr(response_computer_details, 'status_code', None)}\n"
+			f"API Response:  {getattr(response_computer_details, 'text', None)}"
 		)
+		return None
 
-		if response_get_token.status_code == 200:
-			return {
-				"api_token": response_get_token.json().get("token"),
-			}
+	computer_id = response_computer_details.json().get("computer").get("general").get("id")
+	log.debug(f"Computer ID:  {computer_id}")
 
-		return { "error": "ERROR:  Failed to authenticate with the Jamf Pro Server." }
+	if cache:
 
-	except Exception:
-		return { "error": "ERROR:  Failed to connect to the Jamf Pro Server." }
+		try:
+			os.makedirs(os.path.dirname(cache), mode=0o700, exist_ok=True)
+
+			with open(cache, "w") as cache_file:
+				json.dump(cache_key | { "id": computer_id }, cache_file)
+
+		except OSError as error:
+			log.warning(f"Unable to cache the computer ID:  {error}")
+
+	return computer_id
 
 
 ####################################################################################################
@@ -461,7 +2231,18 @@ def main():
 
 		if arg != "":
 
-			if re.match(r'.*("|\').*', arg):
+			# A predicate is one value with spaces and quotes of its own; it is only
+			# unquoted, when it was passed quoted as a whole, and never split into words
+			if ((parse_args and parse_args[-1] == "--log-predicate")
+				or arg.startswith("--log-predicate=")):
+
+				with suppress(ValueError):
+					if len(words := shlex.split(arg)) == 1:
+						arg = words[0]
+
+				parse_args.append(arg)
+
+			elif re.match(r'.*("|\').*', arg):
 				parse_args.extend(shlex.split(arg))
 
 			else:
@@ -486,7 +2267,8 @@ def main():
 		help=("Provide a custom name to tag the resulting archive file with.  This can help to "
 		"differentiate what each log file was intending to collect."), required=False)
 	parser.add_argument("--maxsize", "-m", type=int, default=50000000, required=False,
-		help="Provide a custom max size to override the archive's default 50MB max size.")
+		help=("Provide a custom max size to override the archive's default 50MB max size.  "
+		"Lower priority logs are truncated to their newest lines to fit."))
 	parser.add_argument("--file", "-f", metavar="/path/to/file", type=str, nargs="*",
 		help="Specify specific file path(s) to collect.  Multiple file paths can be passed.",
 		required=False
@@ -495,6 +2277,67 @@ def main():
 		help="Specify a specific directory(ies) to collect.  Multiple directories can be passed.",
 		required=False
 	)
+	parser.add_argument("--include", metavar="PATTERN", type=str, nargs="*", required=False,
+		help=("Only collect the files within --directory that match one of these patterns, "
+		"e.g. \"*.log\".  Patterns match a file's name or its path within the directory."))
+	parser.add_argument("--exclude", metavar="PATTERN", type=str, nargs="*", required=False,
+		help=("Skip the files and directories within --directory that match one of these "
+		"patterns, e.g. \"Caches\" or \"*.sock\"."))
+	parser.add_argument("--max-depth", metavar="N", type=int, required=False,
+		help="Only collect files up to N subdirectories deep within --directory.")
+	parser.add_argument("--max-file-size", metavar="BYTES", type=int, required=False,
+		help="Skip the files within --directory that are larger than this.")
+	parser.add_argument("--max-files", metavar="N", type=int, required=False,
+		help="Collect at most N files from each --directory.")
+	parser.add_argument("--symlinks", choices=("skip", "files", "follow"), default="files",
+		required=False, help=("Whether symbolic links within --directory are skipped, "
+		"followed only to files, or followed to files and directories."))
+	time_window_group = parser.add_mutually_exclusive_group()
+	time_window_group.add_argument("--since", metavar="YYYY-MM-DD[ HH:MM[:SS]]",
+		type=datetime.datetime.fromisoformat, required=False,
+		help="Only collect the lines of logs that were written at or after this time.")
+	time_window_group.add_argument("--last", metavar="DURATION", dest="since", type=time_window,
+		required=False, help=("Only collect the lines of logs that were written within this "
+		"long ago, e.g. 30m, 12h, 1d or 2w."))
+	parser.add_argument("--unified-log", action="store_true", required=False,
+		help=("Collect the unified log with `log show`, from --since/--last or otherwise "
+		f"the last {UNIFIED_LOG_COLLECTOR['last']}."))
+	parser.add_argument("--log-predicate", metavar="PREDICATE", type=str, required=False,
+		help=("Only collect the unified log entries that match this predicate, e.g. "
+		"--log-predicate 'subsystem == \"com.apple.ManagedClient\"'.  As a Jamf Pro "
+		"script parameter, pass the option and the single-quoted predicate together."))
+	parser.add_argument("--log-timeout", metavar="SECONDS", type=int,
+		default=UNIFIED_LOG_COLLECTOR["timeout"], required=False,
+		help="Stop collecting the unified log after this long, keeping what was collected.")
+	parser.add_argument("--log-max-bytes", metavar="BYTES", type=int,
+		default=UNIFIED_LOG_COLLECTOR["max_bytes"], required=False,
+		help="Stop collecting the unified log after this much output, before compression.")
+	parser.add_argument("--incremental", action="store_true", required=False,
+		help=("Only collect what has changed since the last successful upload; new lines "
+		"of logs and files that have changed."))
+	parser.add_argument("--state-dir", metavar="/path/to/directory/", type=str,
+		default="/private/var/db/CollectDiagnostics", required=False,
+		help=("Where the manifest of previous uploads is kept for --incremental and the "
+		"API token for --token-cache."))
+	parser.add_argument("--token-cache", action="store_true", required=False,
+		help=("Cache the Jamf Pro API token in --state-dir, readable only by root, so that "
+		"runs shortly after each other reuse it."))
+	parser.add_argument("--text-codec", choices=TEXT_CODECS.keys(), default="deflate",
+		required=False, help=("Compression method for text files larger than 1MB; bzip2 "
+		"produces smaller archives, but not every unzip tool supports it."))
+	parser.add_argument("--volumes", metavar="N", type=int, default=1, required=False,
+		help=("Split a collection larger than --maxsize into up to N archives, each uploaded "
+		"as its own attachment while the next is built.  Takes the place of --stream-upload."))
+	parser.add_argument("--upload-workers", metavar="N", type=int, default=3, required=False,
+		help="Upload up to N archive volumes at once.")
+	parser.add_argument("--upload-retries", metavar="N", type=int, default=2, required=False,
+		help="Retry a failed archive volume upload up to N times.")
+	parser.add_argument("--compress-workers", "-c", metavar="N", type=int, default=1,
+		help=("Compress up to N files at once.  The archive is identical regardless of the "
+		"value; use the number of CPU cores to speed up large collections."), required=False)
+	parser.add_argument("--stream-upload", action="store_true",
+		help=("Upload the archive while it is being built instead of writing it to "
+		"/private/tmp first."), required=False)
 	parser.add_argument("--quiet", "-q", action="store_true",
 		help="Do not print verbose/debugging messages.", required=False)
 
@@ -520,31 +2363,42 @@ def main():
 		custom_name_tag = ""
 
 	archive_max_size = args.maxsize
+	scan_options = {
+		"include": args.include,
+		"exclude": args.exclude,
+		"max_depth": args.max_depth,
+		"max_file_size": args.max_file_size,
+		"symlinks": args.symlinks,
+		"max_files": args.max_files
+	}
+	# Items are archived by priority, lowest first; when the archive nears its max size,
+	# the items archived last are the ones truncated or skipped
 	upload_items = []
 
 	if args.file:
-		upload_items.extend((file).strip() for file in args.file)
+		upload_items.extend((0, (file).strip()) for file in args.file)
 
 	if args.directory:
-		upload_items.extend((folder).strip() for folder in args.directory)
+		upload_items.extend((0, (folder).strip()) for folder in args.directory)
 
 	if args.defaults:
 		upload_items.extend(
 			[
-				"/private/var/log/jamf.log",
-				"/private/var/log/install.log",
-				"/private/var/log/system.log",
-				"/private/var/log/jamf_RecoveryAgent.log",
-				"/private/var/log/jamf_ReliableEnrollment.log",
-				"/private/var/log/32bitApps_inventory.log",
-				"/opt/ManagedFrameworks/Inventory.plist",
-				"/opt/ManagedFrameworks/EA_History.log",
-				"/opt/ManagedFrameworks/pkg_install.log",
-				"/private/tmp/installed_profiles.xml",
-				"/private/tmp/apns_status.txt"
+				(2, "/private/var/log/jamf.log"),
+				(3, "/private/var/log/install.log"),
+				(4, "/private/var/log/system.log"),
+				(2, "/private/var/log/jamf_RecoveryAgent.log"),
+				(2, "/private/var/log/jamf_ReliableEnrollment.log"),
+				(4, "/private/var/log/32bitApps_inventory.log"),
+				(1, "/opt/ManagedFrameworks/Inventory.plist"),
+				(3, "/opt/ManagedFrameworks/EA_History.log"),
+				(3, "/opt/ManagedFrameworks/pkg_install.log")
 			]
 		)
 
+		# Tables can be a name, or a dict with the "table" name and optionally a "where"
+		# filter and a "limit" on the number of rows, e.g.:
+		# 	{ "table": "kext_policy", "where": "allowed = 1", "limit": 1000 }
 		db_kext = {
 			"database": "/var/db/SystemPolicyConfiguration/KextPolicy",
 			"tables": ["kext_policy_mdm", "kext_policy"],
@@ -554,10 +2408,13 @@ def main():
 	##################################################
 	# Define Variables
 
-	jps_credentials = {
-		"username": decrypt_string(args.secret.strip(), args.api_username.strip()).strip(),
-		"password": decrypt_string(args.secret.strip(), args.api_password.strip()).strip()
-	}
+	jps_url = jamf_pro_url()
+	jamf_pro = JamfProClient(
+		jps_url,
+		decrypt_string(args.secret.strip(), args.api_username.strip()).strip(),
+		decrypt_string(args.secret.strip(), args.api_password.strip()).strip(),
+		token_cache = os.path.join(args.state_dir, "token.json") if args.token_cache else None
+	)
 
 	time_stamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 	archive_file = f"/private/tmp/{time_stamp}{custom_name_tag}_logs.zip"
@@ -573,80 +2430,175 @@ def main():
 	if database_items:
 		log.debug(f"Requested databases:  {database_items}")
 
-	# Get installed Configuration Profiles
-	installed_profiles = execute_process('/usr/bin/profiles show -cached --output "stdout-xml"')
+	computer_id_cache = os.path.join(args.state_dir, "computer_id.json")
 
-	if installed_profiles.get("success"):
-		write_to_file("/private/tmp/installed_profiles.xml", installed_profiles.get("stdout"))
-	else:
-		log.warning("Failed to get locally installed profiles!")
+	if (computer_id := get_computer_id(jamf_pro, hw_UUID, computer_id_cache)) is None:
+		sys.exit(5)
 
-	# Get APNS stats
-	apns_stats = execute_process(
-		'/System/Library/PrivateFrameworks/ApplePushService.framework/apsctl status'
-	)
+	def collect(archive):
 
-	if apns_stats.get("success"):
-		write_to_file("/private/tmp/apns_status.txt", apns_stats.get("stdout"))
-	else:
-		log.warning("Failed to get APNS stats!")
+		if args.unified_log:
+			archive.add_command(
+				UNIFIED_LOG_COLLECTOR["arcname"],
+				unified_log_command(
+					args.log_predicate, args.since, UNIFIED_LOG_COLLECTOR["last"]),
+				timeout = args.log_timeout,
+				max_bytes = args.log_max_bytes,
+				partial = True
+			)
 
-	for upload_item in upload_items:
-		archiver(upload_item, archive=archive_file)
+		if args.defaults:
+			for collector in COMMAND_COLLECTORS.values():
+				archive.add_command(**collector)
 
-	for database_item in database_items:
+		for _, upload_item in sorted(upload_items, key=lambda item: item[0]):
+			archive.add_path(upload_item, since=args.since, **scan_options)
 
-		if os.path.exists(database_item.get("database")):
-			log.info(
-				f"Archiving tables from database:  {os.path.abspath(database_item['database'])}")
+		for database_item in database_items:
+			database = os.path.abspath(database_item.get("database"))
 
-			for table in database_item.get("tables"):
-				log.info(f"Creating csv and archiving table:  {table}")
-				file_name = db_table_writer(database_item.get("database"), table)
-				archiver(os.path.abspath(file_name), archive=archive_file)
+			if not os.path.exists(database):
+				log.warning("Unable to locate the specified database!")
+				continue
 
-		else:
-			log.warning("Unable to locate the specified database!")
+			log.info(f"Archiving tables from database:  {database}")
 
-	archive_size = os.path.getsize(archive_file)
-	log.debug(f"Archive name:  {archive_file}")
-	log.debug(f"Archive size:  {archive_size}")
+			with closing(db_connect(database)) as connection:
 
-	if archive_size > archive_max_size:
-		log.error("Aborting:  File size is larger than allowed!")
-		sys.exit(2)
+				for table in database_item.get("tables"):
 
-	# Query the API to get the computer ID
-	response_computer_details = jamf_pro_api(
-		api_account = jps_credentials,
-		method = "get",
-		endpoint = f"{CLASSIC_API_ENDPOINTS.get('computers_by_udid')}/{hw_UUID}"
+					if isinstance(table, str):
+						table = { "table": table }
+
+					try:
+						archive.add_stream(
+							f"{database.lstrip('/')}/{table['table']}.csv",
+							IteratorStream(db_table_reader(connection, table["table"],
+								table.get("where"), table.get("limit")))
+						)
+
+					except sqlite3.Error as error:
+						log.warning(f"Unable to export table {table['table']}:  {error}")
+
+	manifest = (
+		IncrementalManifest(os.path.join(args.state_dir, "manifest.plist"), jps_url)
+		if args.incremental else None
 	)
 
-	if int(response_computer_details.status_code) == 200:
-		computer_id = response_computer_details.json().get("computer").get("general").get("id")
-		log.debug(f"Computer ID:  {computer_id}")
+	if args.volumes > 1:
+		uploads = {}
+
+		with ThreadPoolExecutor(max_workers=args.upload_workers) as upload_pool:
+
+			def upload_volume(volume):
+				uploads[volume] = upload_pool.submit(
+					upload_archive, jamf_pro, computer_id, volume, retries=args.upload_retries)
+
+			with ArchiveSession(archive_file, workers=args.compress_workers,
+				max_size=archive_max_size, manifest=manifest,
+				text_compression=TEXT_CODECS[args.text_codec],
+				volumes=args.volumes, on_volume=upload_volume) as archive:
+				collect(archive)
+
+		if manifest and not uploads:
+			log.info("Nothing has changed since the last upload.")
+			sys.exit(0)
+
+		failed_volumes = []
+
+		for volume, upload in uploads.items():
+			response_upload_file = upload.result()
+
+			if response_upload_file is not None and int(response_upload_file.status_code) == 201:
+				result = response_upload_file.json() if response_upload_file.content else {}
+				log.debug(f"Uploaded {volume} as file attachment id:  {result.get('id')}")
+
+			else:
+				failed_volumes.append(volume)
+				log.error(f"Failed to upload {volume} to the JPS!\n"
+					f"API Response:  {getattr(response_upload_file, 'text', None)}"
+				)
+
+				if response_upload_file is not None and response_upload_file.status_code == 404:
+					with suppress(OSError):
+						os.remove(computer_id_cache)
+
+		if failed_volumes:
+			sys.exit(6)
+
+		log.info(f"Successfully uploaded the archive in {len(uploads)} volume(s)!")
+
+		if manifest:
+			manifest.save()
+
+		return
+
+	if args.stream_upload:
+		archive_stream = ArchivePipe(collect, max_size=archive_max_size,
+			workers=args.compress_workers, manifest=manifest,
+			text_compression=TEXT_CODECS[args.text_codec])
+
 	else:
-		log.error("Failed to retrieve devices' computer ID!\n"
-			f"API Status Code:  {response_computer_details.status_code}\n"
-			f"API Response:  {response_computer_details.json()}"
-		)
-		sys.exit(5)
+		archive_stream = None
+
+		with ArchiveSession(archive_file, workers=args.compress_workers,
+			max_size=archive_max_size, manifest=manifest,
+			text_compression=TEXT_CODECS[args.text_codec]) as archive:
+			collect(archive)
+
+		if manifest and not archive.recorded:
+			log.info("Nothing has changed since the last upload.")
+			sys.exit(0)
+
+		archive_size = os.path.getsize(archive_file)
+		log.debug(f"Archive name:  {archive_file}")
+		log.debug(f"Archive size:  {archive_size}")
+
+		if archive_size > archive_max_size:
+			log.error("Aborting:  File size is larger than allowed!")
+			sys.exit(2)
 
 	# Upload file via the API
-	response_upload_file = jamf_pro_api(
-		api_account = jps_credentials,
-		method = "post",
-		endpoint = f"{PRO_API_ENDPOINTS.get('computer_attachments')}".format(id=computer_id),
-		receive_content_type = "json",
-		file = archive_file
-	)
+	response_upload_file = upload_archive(
+		jamf_pro, computer_id, archive_file, stream=archive_stream)
+
+	if response_upload_file is not None and int(response_upload_file.status_code) == 404:
+		# The cached computer ID is stale if the record was deleted and the device re-enrolled
+
+		if archive_stream:
+			# A streamed archive cannot be sent again; have the next run look up the ID
+			with suppress(OSError):
+				os.remove(computer_id_cache)
+
+		elif (computer_id := get_computer_id(
+			jamf_pro, hw_UUID, computer_id_cache, refresh=True)) is not None:
+
+			response_upload_file = upload_archive(jamf_pro, computer_id, archive_file)
+
+	if archive_stream:
+		archive_stream.close()
+		log.debug(f"Archive size:  {archive_stream.size}")
+
+		if archive_stream.size > archive_max_size:
+			log.error("Aborting:  File size is larger than allowed!")
+			sys.exit(2)
+
+		elif archive_stream.error:
+			log.error(f"Failed to build the archive:  {archive_stream.error}")
+			sys.exit(6)
+
+	if response_upload_file is None:
+		log.error("Failed to upload file to the JPS!  Unable to connect.")
+		sys.exit(6)
 
 	if int(response_upload_file.status_code) == 201:
 		if result := response_upload_file.content.decode():
 			result = json.loads(result)
 			log.debug(f"Uploaded file attachment id:  {result.get('id')}")
 		log.info("Successfully upload the archive!")
+
+		if manifest:
+			manifest.save()
 	else:
 		log.error("Failed to upload file to the JPS!\n"
 			f"API Response:  {response_upload_file.content.decode()}"
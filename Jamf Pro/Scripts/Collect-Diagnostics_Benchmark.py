@@ -0,0 +1,139 @@
+#!/opt/ManagedFrameworks/Python.framework/Versions/Current/bin/python3
+
+"""
+Script Name:  Collect-Diagnostics_Benchmark.py
+By:  Zack Thompson / Created:  10/18/2026
+Version:  1.0.0 / Updated:  10/18/2026 By:  ZT
+
+Description:  This script measures how long Collect-Diagnostics.py takes to start.
+
+	Collect-Diagnostics.py is imported in a fresh interpreter with `-X importtime` and
+	its `--help` is timed end to end.  The median of each is reported, along with the
+	modules that take the longest to import and any slow-to-load frameworks that were
+	imported eagerly.  Use --max-ms to fail when the import time regresses.
+
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Collect-Diagnostics.py")
+MODULE = os.path.splitext(os.path.basename(SCRIPT))[0]
+
+# Modules Collect-Diagnostics.py only imports when they are needed
+LAZY_MODULES = ("objc", "Foundation", "requests", "cryptography", "urllib.request")
+
+IMPORT_TIME = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_times(python):
+	"""Import Collect-Diagnostics.py in a fresh interpreter.
+
+	Args:
+		python (str): Path to the Python interpreter to use
+	Returns:
+		tuple:  The cumulative import time in microseconds of each module imported
+			directly by the script, the script's own cumulative import time and the
+			slow-to-load modules that were imported
+	"""
+
+	code = (
+		"import sys\n"
+		f"sys.path.insert(0, {os.path.dirname(SCRIPT)!r})\n"
+		f"__import__({MODULE!r})\n"
+		f"print(' '.join(name for name in {LAZY_MODULES!r} if name in sys.modules))\n"
+	)
+	process = subprocess.run([python, "-X", "importtime", "-c", code],
+		capture_output=True, text=True, check=True)
+
+	modules = {}
+	total = None
+	# Modules imported by the top level module that is listed next
+	imported = {}
+
+	for line in process.stderr.splitlines():
+
+		if not (match := IMPORT_TIME.match(line)):
+			continue
+
+		cumulative, indent, name = int(match[2]), len(match[3]), match[4]
+
+		# Each module is listed after the modules it imports, which are indented two spaces
+		if indent == 1 and name == MODULE:
+			modules, total = imported, cumulative
+
+		elif indent == 1:
+			imported = {}
+
+		elif indent == 3:
+			imported[name] = cumulative
+
+	return modules, total, process.stdout.split()
+
+
+def help_time(python):
+	"""Time `Collect-Diagnostics.py --help` from start to exit.
+
+	Args:
+		python (str): Path to the Python interpreter to use
+	Returns:
+		float:  Seconds the script took
+	"""
+
+	started = time.perf_counter()
+	subprocess.run([python, SCRIPT, "--help"], stdout=subprocess.DEVNULL, check=True)
+	return time.perf_counter() - started
+
+
+def main():
+
+	parser = argparse.ArgumentParser(
+		description="Measures how long Collect-Diagnostics.py takes to start.")
+	parser.add_argument("--runs", "-r", metavar="N", type=int, default=5,
+		help="Measure N times and report the median.  Defaults to 5.")
+	parser.add_argument("--top", "-t", metavar="N", type=int, default=10,
+		help="Show the N modules that take the longest to import.  Defaults to 10.")
+	parser.add_argument("--python", metavar="/path/to/python3", default=sys.executable,
+		help="The interpreter to measure with.  Defaults to the one running this script.")
+	parser.add_argument("--max-ms", metavar="MILLISECONDS", type=float,
+		help="Exit with an error if importing the script takes longer than this.")
+	args = parser.parse_args()
+
+	totals = []
+	helps = []
+	modules = {}
+	eager = set()
+
+	for _ in range(args.runs):
+		run_modules, total, run_eager = import_times(args.python)
+		totals.append(total)
+		eager.update(run_eager)
+
+		for name, cumulative in run_modules.items():
+			modules.setdefault(name, []).append(cumulative)
+
+		helps.append(help_time(args.python))
+
+	import_ms = statistics.median(totals) / 1000
+	print(f"Import Collect-Diagnostics.py:  {import_ms:.1f} ms (median of {args.runs})")
+	print(f"Collect-Diagnostics.py --help:  {statistics.median(helps) * 1000:.1f} ms")
+	print(f"Slow-to-load modules imported eagerly:  {', '.join(sorted(eager)) or 'none'}")
+	print("\nSlowest imports (cumulative):")
+
+	for name, times in sorted(
+		modules.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:args.top]:
+		print(f"  {statistics.median(times) / 1000:8.1f} ms  {name}")
+
+	if args.max_ms is not None and import_ms > args.max_ms:
+		print(f"\nImporting took longer than {args.max_ms} ms!")
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()